@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import inspect
+import importlib.util
+import multiprocessing
+import warnings
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import plotly
+
+# 基准测试：按 天数 × SKU 数 生成和真实表结构一样的合成数据，直接在进程内计时 ETL 各阶段和看板回调（不需要浏览器），
+# 结果写成 JSON，方便比较不同版本：
+#   python 基准测试.py --days 60 --skus 500 --output V8.json
+#   python 基准测试.py --inventory-dashboard 米其林-库存软件开发/库存软件开发-V7-优化.py --output V7.json
+#   python 基准测试.py --compare V7.json V8.json
+
+warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
+
+root = os.path.dirname(os.path.abspath(__file__))
+default_scripts = {
+    'inventory_etl': os.path.join(root, '米其林-库存软件开发', '库存软件开发-V2.py'),
+    'inventory_dashboard': os.path.join(root, '米其林-库存软件开发', '库存软件开发-V8-GPT优化.py'),
+    'sales_etl': os.path.join(root, '米其林-运营软件开发', '运营软件开发-V2.py'),
+    'sales_dashboard': os.path.join(root, '米其林-运营软件开发', '运营软件开发-V9.py'),
+}
+
+# 要单独计时的 ETL 阶段（脚本里没有的函数会跳过）
+etl_stages = ['iter_exports', 'probe_keys', 'compile_dictionary', 'enrich', 'compile_costs', 'lookup_costs',
+              'write_snapshot', 'write_cube']
+
+# 要计时的看板回调（脚本里没有的函数会跳过；各版本拆分图表回调的方式不同，有的一个回调出所有图表，有的每个图表一个回调）
+dashboard_callbacks = {
+    'inventory_dashboard': ['update_output', 'update_bar_chart', 'update_city_chart', 'update_combined_chart',
+                            'update_charts'],
+    'sales_dashboard': ['update_figures', 'update_pattern_figure', 'update_visitor_figure', 'update_pieces_figure',
+                        'update_profit_figure'],
+}
+
+city_columns = ['北京现货库存', '上海现货库存', '广州现货库存', '成都现货库存', '武汉现货库存', '沈阳现货库存',
+                '西安现货库存', '德州现货库存']
+patterns = ['PS4', 'PS5', 'P4ST', 'XM2', 'LTX', 'PILOT', 'CC2', 'ENERGY']
+sizes = ['205/55R16', '215/55R17', '225/45R17', '235/45R18', '245/40R18', '255/35R19']
+dims = [16, 17, 18, 19]
+
+
+def generate_dictionary(sku_ids, rng):
+    return pd.DataFrame({
+        'SKU': sku_ids,
+        'CAI': ['CAI%06d' % i for i in range(len(sku_ids))],
+        '花纹': rng.choice(patterns, len(sku_ids)),
+        '尺寸': rng.choice(sizes, len(sku_ids)),
+        'DIM': rng.choice(dims, len(sku_ids)),
+    })
+
+
+def generate_inventory(day, sku_ids, rng):
+    n = len(sku_ids)
+    df = pd.DataFrame({
+        '时间': day.strftime('%Y-%m-%d'),
+        'SKU': sku_ids,
+        '品牌': '米其林',
+        '是否影分身': rng.choice(['是', '否'], n, p=[0.1, 0.9]),
+        '上下柜状态': rng.choice(['上柜', '下柜', '可上柜'], n, p=[0.8, 0.1, 0.1]),
+        '全国现货库存': rng.integers(0, 500, n),
+        '全国采购在途数量': rng.integers(0, 50, n),
+        '全国昨日出库商品件数': rng.integers(0, 30, n),
+    })
+    for city in city_columns:
+        df[city] = rng.integers(0, 60, n)
+    return df
+
+
+def generate_sales(day, sku_ids, rng):
+    n = len(sku_ids)
+    pieces = rng.integers(0, 5, n)
+    return pd.DataFrame({
+        '时间': day.strftime('%Y-%m-%d'),
+        'SKU': sku_ids,
+        '品牌': '米其林',
+        '访客数': rng.integers(0, 200, n),
+        '成交人数': np.minimum(pieces, rng.integers(0, 5, n)),
+        '成交商品件数': pieces,
+        '成交金额': pieces * rng.uniform(400, 900, n).round(1),
+    })
+
+
+def generate_data(data_dir, days, skus, seed=0):
+    # 主表里放前一半的历史，其余每天一个导出文件；最后一天的导出先放在 held 目录，用来测增量导入
+    rng = np.random.default_rng(seed)
+    sku_ids = 100000000000 + np.arange(skus)
+    dictionary_df = generate_dictionary(sku_ids, rng)
+    dates = pd.date_range(end=pd.Timestamp('today').normalize() - pd.Timedelta(days=1), periods=days)
+    template_days = max(days // 2, 1)
+    months = sorted({(d.year, d.month) for d in dates})
+    cost_df = pd.DataFrame({'SKU': sku_ids})
+    for year, month in months:
+        cost_df['%d年%d月成本' % (year, month)] = rng.uniform(350, 700, skus).round(1)
+
+    for name in ['米其林库存', '米其林销售-by day', 'held']:
+        os.makedirs(os.path.join(data_dir, name), exist_ok=True)
+    with pd.ExcelWriter(os.path.join(data_dir, '米其林库存监测表.xlsx')) as writer:
+        pd.concat([generate_inventory(d, sku_ids, rng) for d in dates[:template_days]]).to_excel(
+            writer, index=False, sheet_name='原始数据')
+        dictionary_df.to_excel(writer, index=False, sheet_name='字典')
+    with pd.ExcelWriter(os.path.join(data_dir, '米其林销售表-by day.xlsx')) as writer:
+        pd.concat([generate_sales(d, sku_ids, rng) for d in dates[:template_days]]).to_excel(
+            writer, index=False, sheet_name='原始数据')
+        dictionary_df.to_excel(writer, index=False, sheet_name='字典')
+        cost_df.to_excel(writer, index=False, sheet_name='采购成本')
+    for i, day in enumerate(dates[template_days:]):
+        held = i == len(dates) - template_days - 1
+        filename = day.strftime('%Y%m%d') + '.xlsx'
+        generate_inventory(day, sku_ids, rng).to_excel(
+            os.path.join(data_dir, 'held' if held else '米其林库存', 'inventory-' + filename if held else filename), index=False)
+        generate_sales(day, sku_ids, rng).to_excel(
+            os.path.join(data_dir, 'held' if held else '米其林销售-by day', 'sales-' + filename if held else filename), index=False)
+    return dates
+
+
+def load_script(path, name):
+    # 按文件路径导入脚本（文件名不是合法的模块名），返回模块和导入耗时
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module, time.perf_counter() - start
+
+
+def time_stages(module, names, timings):
+    # 把模块里的阶段函数换成计时版本，merge_exports 调用它们时累计耗时
+    for name in names:
+        func = getattr(module, name, None)
+        if func is None:
+            continue
+
+        if inspect.isgeneratorfunction(func):
+            # 生成器（例如逐块产出导出数据的 iter_exports）只累计取下一块的耗时，调用方处理每块的时间不算在内
+            def timed(*args, _func=func, _name=name, **kwargs):
+                chunks = _func(*args, **kwargs)
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        return
+                    finally:
+                        timings[_name] = timings.get(_name, 0.0) + time.perf_counter() - start
+                    yield chunk
+        else:
+            def timed(*args, _func=func, _name=name, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return _func(*args, **kwargs)
+                finally:
+                    timings[_name] = timings.get(_name, 0.0) + time.perf_counter() - start
+
+        timed.__wrapped__ = func
+        setattr(module, name, timed)
+
+
+def run_etl(kind, path, data_dir):
+    module, import_seconds = load_script(path, 'bench_' + kind)
+    result = {'script': os.path.relpath(path, root), 'import_seconds': import_seconds}
+    if not hasattr(module, 'merge_exports'):
+        result['error'] = '脚本里没有 merge_exports()'
+        return result
+
+    for run in ['full', 'incremental']:
+        if run == 'incremental':
+            # 放入最后一天的导出文件，再跑一次
+            prefix, folder = ('inventory-', '米其林库存') if kind == 'inventory_etl' else ('sales-', '米其林销售-by day')
+            for filename in os.listdir(os.path.join(data_dir, 'held')):
+                if filename.startswith(prefix):
+                    shutil.move(os.path.join(data_dir, 'held', filename),
+                                os.path.join(data_dir, folder, filename[len(prefix):]))
+        timings = {}
+        time_stages(module, etl_stages, timings)
+        start = time.perf_counter()
+        module.merge_exports()
+        total = time.perf_counter() - start
+        # 换回原来的函数，第二次运行时不会套两层计时
+        for name in etl_stages:
+            if hasattr(getattr(module, name, None), '__wrapped__'):
+                setattr(module, name, getattr(module, name).__wrapped__)
+        stages = {name: round(seconds, 6) for name, seconds in timings.items()}
+        stages['other'] = round(total - sum(timings.values()), 6)
+        result[run] = {'total_seconds': round(total, 6), 'stages': stages}
+    return result
+
+
+def inventory_scenarios(dates):
+    start, end = dates[0].strftime('%Y-%m-%d'), dates[-1].strftime('%Y-%m-%d')
+    recent = dates[max(len(dates) - 30, 0)].strftime('%Y-%m-%d')
+    return {
+        '全部': (start, end, ['ALL'], ['ALL'], ['ALL'], None),
+        '最近30天': (recent, end, ['ALL'], ['ALL'], ['ALL'], None),
+        '两个花纹': (start, end, patterns[:2], ['ALL'], ['ALL'], None),
+        '尺寸和DIM': (start, end, ['ALL'], sizes[:3], dims[:2], None),
+        '搜索CAI': (start, end, ['ALL'], ['ALL'], ['ALL'], 'CAI00001'),
+    }
+
+
+def sales_scenarios(dates):
+    start, end = dates[0].strftime('%Y-%m-%d'), dates[-1].strftime('%Y-%m-%d')
+    recent = dates[max(len(dates) - 30, 0)].strftime('%Y-%m-%d')
+    return {
+        '全部': (start, end, ['All'], ['All'], ['All'], None),
+        '最近30天': (recent, end, ['All'], ['All'], ['All'], None),
+        '两个花纹': (start, end, patterns[:2], ['All'], ['All'], None),
+        '尺寸和DIM': (start, end, ['All'], sizes[:3], dims[:2], None),
+        '搜索SKU': (start, end, ['All'], ['All'], ['All'], '100000000001'),
+    }
+
+
+def run_dashboard(kind, path, dates, repeat):
+    module, import_seconds = load_script(path, 'bench_' + kind)
+    result = {'script': os.path.relpath(path, root), 'import_seconds': round(import_seconds, 6), 'callbacks': {}}
+    scenarios = inventory_scenarios(dates) if kind == 'inventory_dashboard' else sales_scenarios(dates)
+    for name in dashboard_callbacks[kind]:
+        callback = getattr(module, name, None)
+        if callback is None:
+            continue
+        for scenario, args in scenarios.items():
+            seconds = []
+            try:
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    output = callback(*args)
+                    seconds.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                payload = json.dumps(output, cls=plotly.utils.PlotlyJSONEncoder)
+                serialize_seconds = time.perf_counter() - start
+            except Exception as e:
+                result['callbacks'][name + '/' + scenario] = {'error': '%s: %s' % (type(e).__name__, e)}
+                continue
+            # 回调有结果缓存时第一次是未命中，后面几次是命中
+            result['callbacks'][name + '/' + scenario] = {
+                'first_seconds': round(seconds[0], 6),
+                'min_seconds': round(min(seconds), 6),
+                'median_seconds': round(statistics.median(seconds), 6),
+                'serialize_seconds': round(serialize_seconds, 6),
+                'payload_bytes': len(payload.encode('utf-8')),
+            }
+    return result
+
+
+def compare(old_file, new_file):
+    # 比较两次结果里同名的计时项，打印新/旧的倍数
+    with open(old_file, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_file, encoding='utf-8') as f:
+        new = json.load(f)
+
+    def flatten(data, prefix=''):
+        items = {}
+        for key, value in data.items():
+            if isinstance(value, dict):
+                items.update(flatten(value, prefix + key + '.'))
+            elif key.endswith('seconds') and isinstance(value, (int, float)):
+                items[prefix + key] = value
+        return items
+
+    old_items, new_items = flatten(old['results']), flatten(new['results'])
+    for key in sorted(old_items.keys() & new_items.keys()):
+        ratio = new_items[key] / old_items[key] if old_items[key] else float('nan')
+        print('%-70s %10.4f %10.4f  x%.2f' % (key, old_items[key], new_items[key], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='米其林库存 / 销售两条流水线的基准测试')
+    parser.add_argument('--days', type=int, default=30, help='生成多少天的数据')
+    parser.add_argument('--skus', type=int, default=500, help='每天多少个 SKU')
+    parser.add_argument('--repeat', type=int, default=5, help='每个回调场景重复几次')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help='ETL 并行读取的进程数')
+    parser.add_argument('--data-dir', default=None, help='生成数据的目录，默认用临时目录并在结束后删除')
+    parser.add_argument('--output', default=None, help='结果 JSON 文件')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='比较两个结果文件')
+    for kind, path in default_scripts.items():
+        parser.add_argument('--' + kind.replace('_', '-'), default=path)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    data_dir = os.path.abspath(args.data_dir or tempfile.mkdtemp(prefix='mql-bench-'))
+    os.makedirs(data_dir, exist_ok=True)
+    os.environ['MQL_DATA_DIR'] = data_dir
+    # 按路径导入的脚本在 spawn 方式（Windows）的子进程里找不到，只有 fork 时才并行读取
+    if args.workers is None:
+        args.workers = (os.cpu_count() or 1) if multiprocessing.get_start_method() == 'fork' else 1
+    os.environ['MQL_INGEST_WORKERS'] = str(args.workers)
+    # 回调耗时由基准测试自己计时，不往数据目录里写监控指标（临时目录删掉后进程退出时也不会再去写）
+    os.environ['MQL_METRICS'] = '0'
+
+    scripts = {kind: os.path.abspath(getattr(args, kind)) for kind in default_scripts}
+    cwd = os.getcwd()
+    output = args.output or os.path.join(cwd, 'benchmark-%s.json' % datetime.now().strftime('%Y%m%d-%H%M%S'))
+    os.chdir(data_dir)
+    try:
+        start = time.perf_counter()
+        dates = generate_data(data_dir, args.days, args.skus, args.seed)
+        results = {'generate_seconds': round(time.perf_counter() - start, 6)}
+        for kind in ['inventory_etl', 'sales_etl']:
+            results[kind] = run_etl(kind, scripts[kind], data_dir)
+        for kind in ['inventory_dashboard', 'sales_dashboard']:
+            results[kind] = run_dashboard(kind, scripts[kind], dates, args.repeat)
+    finally:
+        os.chdir(cwd)
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'days': args.days,
+            'skus': args.skus,
+            'rows_per_table': args.days * args.skus,
+            'repeat': args.repeat,
+            'workers': args.workers,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    print('结果已写入', output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,87 +1,193 @@
 import os
+import sys
+import itertools
+import logging
 import pandas as pd
+import numpy as np
 import warnings
 from dash import Dash, dcc, html, dash_table
 from dash.dependencies import Input, Output
 from datetime import datetime
 
+# 两个数据处理脚本共用的增量导入代码在运营软件开发目录的 数据处理公共.py（和 app.py 放在一起）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '米其林-运营软件开发'))
+from 数据处理公共 import (history_format, file_entry, load_manifest, save_manifest, iter_exports, snapshot_version,
+                    write_snapshot, new_generation, save_history, load_history, save_key_index, probe_keys,
+                    compile_dictionary, enrich, write_cube)
+
 # 忽略openpyxl的警告
 warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
-
-# 读取主表
-template_file = r'C:\GPT\米其林库存监测表.xlsx'
-with pd.ExcelFile(template_file) as xls:
-    template_df = pd.read_excel(xls, sheet_name='原始数据')
-    dictionary_df = pd.read_excel(xls, sheet_name='字典')
-
-# 遍历指定目录下的所有Excel文件
-folder = r'C:\GPT\米其林库存'
-for filename in os.listdir(folder):
-    if filename.endswith('.xlsx'):
-        # 读取数据
-        df = pd.read_excel(os.path.join(folder, filename))
-        # 将数据添加到主表中
-        template_df = pd.concat([template_df, df], ignore_index=True)
-
-# 去重
-template_df.drop_duplicates(subset=['时间', 'SKU'], keep='first', inplace=True)
-
-# 筛选 "是否影分身" 列，删除选项 “是” 的行数据
-template_df = template_df.query("`是否影分身` != '是'")
-
-# 筛选 "上下柜状态" 列，删除选项 “下柜” 和 “可上柜” 的行数据
-template_df = template_df.query("`上下柜状态` != '下柜' and `上下柜状态` != '可上柜'")
-
-# 根据SKU从字典表中匹配数据，并替换主表中的数据
-template_df = template_df.merge(dictionary_df[['SKU', 'CAI', '花纹', '尺寸', 'DIM']], on='SKU', how='left')
-
-# 将新数据插入到原有列之间
-column_order = template_df.columns.tolist()
-for col in ['CAI', '花纹', '尺寸', 'DIM']:
-    column_order.insert(column_order.index('品牌'), column_order.pop(column_order.index(col)))
-
-template_df = template_df[column_order]
-
-# 生成新文件名，包含当前日期
-new_file = r'C:\GPT\米其林库存监测表—' + datetime.now().strftime('%Y%m%d') + '.xlsx'
-
-# 使用 ExcelWriter 保存多个表到同一个 Excel 文件中
-with pd.ExcelWriter(new_file) as writer:
-    template_df.to_excel(writer, index=False, sheet_name='原始数据')
-    dictionary_df.to_excel(writer, index=False, sheet_name='字典')
-
-app = Dash(__name__)
-
-df = pd.read_excel(new_file, sheet_name='原始数据')
-df['时间'] = pd.to_datetime(df['时间'])
-
-app.layout = html.Div([
-    dcc.DatePickerRange(
-        id='my-date-picker-range',
-        min_date_allowed=df['时间'].min(),
-        max_date_allowed=df['时间'].max(),
-        initial_visible_month=df['时间'].min(),
-        start_date=df['时间'].min(),
-        end_date=df['时间'].max()
-    ),
-    html.Div(id='output-container-date-picker-range'),
-    dash_table.DataTable(
-        id='table',
-        columns=[{"name": i, "id": i} for i in df.columns],
-        data=df.to_dict('records'),
-    )
-])
-
-@app.callback(
-    Output('output-container-date-picker-range', 'children'),
-    Output('table', 'data'),
-    [Input('my-date-picker-range', 'start_date'),
-     Input('my-date-picker-range', 'end_date')])
-def update_output(start_date, end_date):
-    dff = df.loc[(df['时间'] >= start_date) & (df['时间'] <= end_date)]
-    data = dff.to_dict('records')
-    return f"Start Date: {start_date} End Date: {end_date}", data
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+# 数据目录，可以用环境变量 MQL_DATA_DIR 指向别的目录（例如基准测试生成的数据）
+data_dir = os.environ.get('MQL_DATA_DIR', r'C:\GPT')
+
+template_file = os.path.join(data_dir, '米其林库存监测表.xlsx')
+folder = os.path.join(data_dir, '米其林库存')
+
+# 已导入文件清单和累计历史（去重、筛选后），用于增量导入
+manifest_file = os.path.join(data_dir, '米其林库存-manifest.json')
+history_file = os.path.join(data_dir, '米其林库存-history.pkl')
+# 累计历史的 (时间, SKU) 键索引：排好序的 int64 键、SKU 词表和每行的 SKU 编号
+key_index_file = os.path.join(data_dir, '米其林库存-history.keys.npz')
+# 编译后的字典（SKU 词表 + 分类编码的属性），按字典表内容的哈希判断是否需要重新编译
+dictionary_cache_file = os.path.join(data_dir, '米其林库存-字典.pkl')
+
+# 并行读取Excel的进程数，默认使用全部CPU核心
+ingest_workers = int(os.environ.get('MQL_INGEST_WORKERS', os.cpu_count() or 1))
+
+# 预汇总表（cube）的维度和可加的度量
+cube_dimensions = ['时间', '花纹', '尺寸', 'DIM']
+cube_measures = ['全国现货库存', '全国采购在途数量', '全国昨日出库商品件数', '北京现货库存', '上海现货库存', '广州现货库存',
+                 '成都现货库存', '武汉现货库存', '沈阳现货库存', '西安现货库存', '德州现货库存']
+
+# 超过这个大小（MB）的导出文件改用流式读取，峰值内存只和每批行数有关，与文件大小无关
+stream_threshold_mb = float(os.environ.get('MQL_STREAM_THRESHOLD_MB', 20))
+stream_chunk_rows = 50000
+# 导出文件只读这些列，用环境变量 MQL_EXPORT_USECOLS 设置（逗号分隔，不设表示全部列）；
+# 去重、筛选和排列列顺序要用的列总会读
+export_usecols = os.environ.get('MQL_EXPORT_USECOLS')
+if export_usecols:
+    export_usecols = {name.strip() for name in export_usecols.split(',')} | {'时间', 'SKU', '品牌', '是否影分身', '上下柜状态'}
+else:
+    export_usecols = None
+
+
+def keep_rows(df):
+    # 筛选 "是否影分身" 列，删除选项 “是” 的行数据；筛选 "上下柜状态" 列，删除选项 “下柜” 和 “可上柜” 的行数据
+    keep = pd.Series(True, index=df.index)
+    if '是否影分身' in df:
+        keep &= df['是否影分身'] != '是'
+    if '上下柜状态' in df:
+        keep &= (df['上下柜状态'] != '下柜') & (df['上下柜状态'] != '可上柜')
+    return keep.to_numpy()
+
+
+def merge_exports():
+    manifest = load_manifest(manifest_file, history_file, key_index_file)
+    template_entry = file_entry(template_file, manifest['template'])
+    exports = {}
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith('.xlsx'):
+            exports[filename] = file_entry(os.path.join(folder, filename), manifest['files'].get(filename))
+
+    # 主表变了，或者已导入的文件被修改、删除时，只追加新文件会和全量结果不一致，需要全量重建
+    full_rebuild = manifest['template'] is None or manifest['template']['sha256'] != template_entry['sha256']
+    for filename, entry in manifest['files'].items():
+        if filename not in exports or exports[filename]['sha256'] != entry['sha256']:
+            full_rebuild = True
+    # 新文件的文件名排在已导入的文件前面时（补发的早几天的导出），全量合并时它排在前面，重复的 (时间, SKU) 保留它的行；
+    # 只追加到累计历史后面会保留另一行，也要全量重建
+    new_names = [filename for filename in exports if filename not in manifest['files']]
+    if new_names and manifest['files'] and min(new_names) < max(manifest['files']):
+        full_rebuild = True
+    # 增量导入要用上次的累计历史和键索引，读不出来或三份文件对不上时也全量重建
+    history = None if full_rebuild else load_history(manifest, history_file, key_index_file)
+    full_rebuild = history is None
+
+    # 读取主表
+    with pd.ExcelFile(template_file) as xls:
+        if full_rebuild:
+            template_df = pd.read_excel(xls, sheet_name='原始数据')
+        dictionary_df = pd.read_excel(xls, sheet_name='字典')
+
+    if full_rebuild:
+        new_files = list(exports)
+        parts, code_parts = [], []
+        skus, keys = pd.Index([], dtype=object), np.empty(0, dtype=np.int64)
+        frames = [template_df]
+    else:
+        # 增量导入：在上次的累计历史上只追加新文件
+        new_files = new_names
+        history_df, skus, keys, row_codes = history
+        parts, code_parts = [history_df], [row_codes]
+        frames = []
+
+    # 按文件顺序逐块去重、筛选（小文件并行读取，大文件流式读取）：每块先探测持久化的键索引，
+    # 结果和对全部历史做 drop_duplicates(subset=['时间', 'SKU'], keep='first') 一样；
+    # 去重之后再筛选，被筛掉的行的键仍留在键索引里，结果不受读取方式影响，内存里只留筛选后的行
+    paths = [os.path.join(folder, filename) for filename in new_files]
+    for df in itertools.chain(frames, iter_exports(paths, ingest_workers, export_usecols, stream_threshold_mb,
+                                                   stream_chunk_rows)):
+        is_new, codes, skus, keys = probe_keys(df, skus, keys)
+        keep = is_new & keep_rows(df)
+        # 整块都被去掉时不留空表，免得拼接时空列把其他块的列类型带成 object
+        if keep.any() or not parts:
+            parts.append(df[keep])
+            code_parts.append(codes[keep])
+    history_df = pd.concat(parts, ignore_index=True)
+    row_codes = np.concatenate(code_parts)
+    # 累计历史要保持原样保存，下面添加的字典列只加在浅拷贝上
+    template_df = history_df.copy(deep=False)
+
+    # 根据SKU从编译好的字典中匹配数据，添加到主表中
+    enrich(template_df, row_codes, skus, compile_dictionary(dictionary_df, dictionary_cache_file))
+
+    # 将新数据插入到原有列之间
+    column_order = template_df.columns.tolist()
+    for col in ['CAI', '花纹', '尺寸', 'DIM']:
+        column_order.insert(column_order.index('品牌'), column_order.pop(column_order.index(col)))
+
+    template_df = template_df[column_order]
+
+    # 生成新文件名，包含当前日期
+    new_file = os.path.join(data_dir, '米其林库存监测表—' + datetime.now().strftime('%Y%m%d') + '.xlsx')
+
+    # 使用 ExcelWriter 保存多个表到同一个 Excel 文件中；先写到临时文件再替换，看板不会读到写了一半的文件
+    tmp_file = os.path.splitext(new_file)[0] + '.tmp.xlsx'
+    with pd.ExcelWriter(tmp_file) as writer:
+        template_df.to_excel(writer, index=False, sheet_name='原始数据')
+        dictionary_df.to_excel(writer, index=False, sheet_name='字典')
+    os.replace(tmp_file, new_file)
+    # 快照和预汇总表是同一个版本：先写预汇总表，写快照时最后替换指针，看板不会拿到新快照配旧预汇总表
+    version = snapshot_version()
+    write_cube(template_df, new_file, version, cube_dimensions, cube_measures)
+    write_snapshot(template_df, new_file, version, cube_measures)
+
+    # 结果写完后再更新累计历史、键索引和清单，三份都带同一个新代号和行数，最后写清单；
+    # 中途失败时下次会发现三份对不上，全量重建
+    generation = new_generation()
+    save_history(history_df, generation, history_file)
+    save_key_index(skus, keys, row_codes, generation, key_index_file)
+    save_manifest({'format': history_format, 'generation': generation, 'rows': len(history_df),
+                   'template': template_entry, 'files': exports}, manifest_file)
+
+    return new_file
 
 
 if __name__ == '__main__':
+    new_file = merge_exports()
+
+    app = Dash(__name__)
+
+    df = pd.read_excel(new_file, sheet_name='原始数据')
+    df['时间'] = pd.to_datetime(df['时间'])
+
+    app.layout = html.Div([
+        dcc.DatePickerRange(
+            id='my-date-picker-range',
+            min_date_allowed=df['时间'].min(),
+            max_date_allowed=df['时间'].max(),
+            initial_visible_month=df['时间'].min(),
+            start_date=df['时间'].min(),
+            end_date=df['时间'].max()
+        ),
+        html.Div(id='output-container-date-picker-range'),
+        dash_table.DataTable(
+            id='table',
+            columns=[{"name": i, "id": i} for i in df.columns],
+            data=df.to_dict('records'),
+        )
+    ])
+
+    @app.callback(
+        Output('output-container-date-picker-range', 'children'),
+        Output('table', 'data'),
+        [Input('my-date-picker-range', 'start_date'),
+         Input('my-date-picker-range', 'end_date')])
+    def update_output(start_date, end_date):
+        dff = df.loc[(df['时间'] >= start_date) & (df['时间'] <= end_date)]
+        data = dff.to_dict('records')
+        return f"Start Date: {start_date} End Date: {end_date}", data
+
     app.run_server(debug=True)
@@ -9,7 +9,10 @@ from datetime import datetime
 
 warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
 
-new_file = r'C:\GPT\米其林库存监测表—' + datetime.now().strftime('%Y%m%d') + '.xlsx'
+# 数据目录，可以用环境变量 MQL_DATA_DIR 指向别的目录（例如基准测试生成的数据）
+data_dir = os.environ.get('MQL_DATA_DIR', r'C:\GPT')
+
+new_file = os.path.join(data_dir, '米其林库存监测表—' + datetime.now().strftime('%Y%m%d') + '.xlsx')
 df = pd.read_excel(new_file, sheet_name='原始数据')
 df['时间'] = pd.to_datetime(df['时间'])
 
@@ -1,194 +1,409 @@
 import os
+import sys
+import time
+import base64
+import logging
+import threading
+import numpy as np
 import pandas as pd
 import warnings
 import plotly.graph_objects as go
-from dash import Dash, dcc, html
+from dash import Dash, dcc, html, Patch
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
-from datetime import datetime
 from dash_extensions.enrich import DashProxy
 from dash.exceptions import PreventUpdate
 import flask_caching
 
+# 几个看板共用的代码在运营软件开发目录的 看板公共.py（和 app.py 放在一起）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '米其林-运营软件开发'))
+from 看板公共 import (current_snapshot, load_data, load_cube, compact, sort_by_time, build_time_axis, date_range_rows,
+                  build_groups, grouped, build_index, lookup_rows, build_search_index, search_rows, data_version,
+                  find_data_file, load_latest, query_key, single_flight, background_manager, background_options,
+                  dimmed, instrumented, stage, count_rows, count_cache, add_metrics_routes)
+
 warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
 
-new_file = r'C:\GPT\米其林库存监测表—' + datetime.now().strftime('%Y%m%d') + '.xlsx'
-df = pd.read_excel(new_file, sheet_name='原始数据')
-df['时间'] = pd.to_datetime(df['时间'])
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+# 数据目录，可以用环境变量 MQL_DATA_DIR 指向别的目录（例如基准测试生成的数据）
+data_dir = os.environ.get('MQL_DATA_DIR', r'C:\GPT')
+
+
+# 维度列和城市库存列
+dimension_columns = ['花纹', '尺寸', 'DIM']
+city_columns = ['北京现货库存', '上海现货库存', '广州现货库存', '成都现货库存', '武汉现货库存', '沈阳现货库存',
+                '西安现货库存', '德州现货库存']
+# 维度列转成 category，分组更快、常驻内存更小；整数度量列在 ETL 写快照时已经收窄
+schema = dict.fromkeys(['花纹', '尺寸', 'DIM', 'SKU', 'CAI', '上下柜状态', '是否影分身'], 'category')
+schema.update(dict.fromkeys(['全国现货库存', '全国采购在途数量', '全国昨日出库商品件数'] + city_columns, 'measure'))
+
+data_prefix = '米其林库存监测表—'
+# 多久检查一次有没有新的数据文件（秒），0 表示不检查
+reload_seconds = int(os.environ.get('MQL_RELOAD_SECONDS', 60))
+
+
+def load_dataset(new_file):
+    # 读取一个版本的数据并建好所有索引；回调只通过 dataset 这一个引用取数据，换版本时整体替换
+    version = data_version(new_file)
+    # 指针只读一次，明细和预汇总表一定是同一个版本
+    snapshot_file = current_snapshot(new_file)
+    df = load_data(new_file, snapshot_file)
+    df['时间'] = pd.to_datetime(df['时间'])
+
+    # Convert SKU and CAI to string for search
+    df['SKU'] = df['SKU'].astype(str)
+    df['CAI'] = df['CAI'].astype(str)
+
+    # 明细和预汇总表都按时间排序，日期范围用二分查找直接切片
+    df = sort_by_time(df)
+    cube = sort_by_time(load_cube(snapshot_file, df))
+    df_axis = build_time_axis(df)
+    cube_axis = df_axis if cube is df else build_time_axis(cube)
+
+    # 字典里没有的 SKU 花纹/尺寸/DIM 为空，加载时一次性归到 0 这一组（以前每次回调合并日期后 fillna(0) 也是这个结果）
+    df[dimension_columns] = df[dimension_columns].fillna(0)
+    cube[dimension_columns] = cube[dimension_columns].fillna(0)
+
+    df = compact(df, schema, '明细')
+    if cube is not df:
+        cube = compact(cube, schema, '预汇总表')
+
+    # 按花纹、按日期分组用的整数编码
+    df_groups = build_groups(df, df_axis)
+    cube_groups = df_groups if cube is df else build_groups(cube, cube_axis)
+
+    # 花纹/尺寸/DIM 的倒排索引，筛选时先求行号再只 take 一次，不再对整张表 isin 三遍
+    df_index = build_index(df, dimension_columns)
+    cube_index = df_index if cube is df else build_index(cube, dimension_columns)
+
+    return {
+        'path': new_file,
+        'version': version,
+        'df': df,
+        'cube': cube,
+        'df_axis': df_axis,
+        'cube_axis': cube_axis,
+        'df_groups': df_groups,
+        'cube_groups': cube_groups,
+        'df_index': df_index,
+        'cube_index': cube_index,
+        # SKU/CAI 搜索索引，搜索时不再对每一行做字符串比较
+        'search_index': build_search_index(df, ['SKU', 'CAI']),
+        # 完整的日历，回调里只把汇总后的按日序列对齐到这个日历上，缺数据的日期补 0
+        'all_dates': pd.date_range(start=df['时间'].min(), end=df['时间'].max()),
+    }
 
-# Convert SKU and CAI to string for search
-df['SKU'] = df['SKU'].astype(str)
-df['CAI'] = df['CAI'].astype(str)
 
-# Create a new dataframe with all dates
-all_dates = pd.date_range(start=df['时间'].min(), end=df['时间'].max())
-df_all_dates = pd.DataFrame(all_dates, columns=['时间'])
+# 最新一天的数据读不了时退回前一天的
+dataset = load_latest(data_dir, data_prefix, load_dataset)
 
 app = DashProxy(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+# 图表结果缓存：键是规范化的筛选条件加数据版本，最多保留 MQL_CACHE_ENTRIES 组结果，超出时淘汰最久没用的
 cache = flask_caching.Cache(app.server, config={
-    'CACHE_TYPE': 'filesystem',
-    'CACHE_DIR': 'cache-directory'
+    'CACHE_TYPE': '看板公共.LRUCache',
+    'CACHE_THRESHOLD': int(os.environ.get('MQL_CACHE_ENTRIES', 64)),
 })
+# 各个工作进程共用的图表结果缓存：键同样是数据版本加规范化的筛选条件，最多保留 MQL_SHARED_CACHE_ENTRIES 组结果。
+# 早上 ETL 跑完后很多人同时打开默认视图，只有一个进程在算，其余的等它写进来直接读
+shared_cache = flask_caching.Cache(app.server, config={
+    'CACHE_TYPE': '看板公共.SQLiteCache',
+    'CACHE_PATH': os.environ.get('MQL_SHARED_CACHE', os.path.join(data_dir, '米其林库存-结果缓存.sqlite')),
+    'CACHE_THRESHOLD': int(os.environ.get('MQL_SHARED_CACHE_ENTRIES', 256)),
+})
+# 回调在后台进程里算（不能用时返回 None，照常在请求线程里算）
+manager = background_manager(os.path.join(data_dir, '米其林库存-后台任务'))
+# 每个回调的耗时、行数、缓存命中和返回字节数，/metrics 输出
+add_metrics_routes(app.server, os.path.join(data_dir, '米其林库存-监控指标.sqlite'))
 
-app.layout = dbc.Container([
-    dbc.Row([
-        dbc.Col([
-            html.Div([
-                dbc.Label('Start Date: '),
-                dcc.DatePickerSingle(
-                    id='start_date',
-                    min_date_allowed=df['时间'].min(),
-                    max_date_allowed=df['时间'].max(),
-                    initial_visible_month=df['时间'].min(),
-                    date=df['时间'].min()
-                ),
-                dbc.Label('End Date: '),
-                dcc.DatePickerSingle(
-                    id='end_date',
-                    min_date_allowed=df['时间'].min(),
-                    max_date_allowed=df['时间'].max(),
-                    initial_visible_month=df['时间'].min(),
-                    date=df['时间'].max()
-                ),
-                dbc.Label('Flower Patterns: '),
-                dcc.Dropdown(
-                    id='flower-pattern',
-                    options=[{'label': 'ALL', 'value': 'ALL'}] + [{'label': i, 'value': i} for i in
-                                                                  df['花纹'].unique()],
-                    value=['ALL'],
-                    multi=True,
-                    placeholder="Select Flower Patterns",
-                ),
-                dbc.Label('Sizes: '),
-                dcc.Dropdown(
-                    id='size',
-                    options=[{'label': 'ALL', 'value': 'ALL'}] + [{'label': i, 'value': i} for i in
-                                                                  df['尺寸'].unique()],
-                    value=['ALL'],
-                    multi=True,
-                    placeholder="Select Sizes",
-                ),
-                dbc.Label('DIMs: '),
-                dcc.Dropdown(
-                    id='dim',
-                    options=[{'label': 'ALL', 'value': 'ALL'}] + [{'label': i, 'value': i} for i in df['DIM'].unique()],
-                    value=['ALL'],
-                    multi=True,
-                    placeholder="Select DIMs",
-                ),
-                dbc.Label('Search SKU or CAI: '),
-                dcc.Input(
-                    id='search_input',
-                    type='text',
-                    placeholder='Enter SKU or CAI',
-                )
-            ]),
-            html.Div(id='output-container-date-picker-range'),
-        ], width=3),
-        dbc.Col([
-            dcc.Graph(id='bar-chart'),
-            dcc.Graph(id='city-bar-chart'),
-            dcc.Graph(id='combined-chart'),
-        ], width=9),
-    ]),
-], fluid=True)
-
-@app.callback(
-    [Output('output-container-date-picker-range', 'children'),
-     Output('bar-chart', 'figure'),
-     Output('city-bar-chart', 'figure'),
-     Output('combined-chart', 'figure')],
-    [Input('start_date', 'date'),
-     Input('end_date', 'date'),
-     Input('flower-pattern', 'value'),
-     Input('size', 'value'),
-     Input('dim', 'value'),
-     Input('search_input', 'value')],
-    prevent_initial_call=True)
-def update_output(start_date, end_date, flower_patterns, sizes, dims, search_input):
-    try:
-        dff = pd.merge(df_all_dates, df, how='left', on='时间')
-        dff.fillna(0, inplace=True)
-        dff = dff.loc[(dff['时间'] >= pd.to_datetime(start_date)) & (dff['时间'] <= pd.to_datetime(end_date))]
 
-        if 'ALL' not in flower_patterns:
-            dff = dff[dff['花纹'].isin(flower_patterns)]
-        if 'ALL' not in sizes:
-            dff = dff[dff['尺寸'].isin(sizes)]
-        if 'ALL' not in dims:
-            dff = dff[dff['DIM'].isin(dims)]
+def dropdown_options(values):
+    return [{'label': 'ALL', 'value': 'ALL'}] + [{'label': i, 'value': i} for i in values]
+
+
+def serve_layout():
+    # 每次打开页面时按当前数据生成，日期范围和下拉选项跟着数据版本走
+    data = dataset
+    df = data['df']
+    return dbc.Container([
+        dbc.Row([
+            dbc.Col([
+                html.Div([
+                    dbc.Label('Start Date: '),
+                    dcc.DatePickerSingle(
+                        id='start_date',
+                        min_date_allowed=df['时间'].min(),
+                        max_date_allowed=df['时间'].max(),
+                        initial_visible_month=df['时间'].min(),
+                        date=df['时间'].min()
+                    ),
+                    dbc.Label('End Date: '),
+                    dcc.DatePickerSingle(
+                        id='end_date',
+                        min_date_allowed=df['时间'].min(),
+                        max_date_allowed=df['时间'].max(),
+                        initial_visible_month=df['时间'].min(),
+                        date=df['时间'].max()
+                    ),
+                    dbc.Label('Flower Patterns: '),
+                    dcc.Dropdown(
+                        id='flower-pattern',
+                        options=dropdown_options(df['花纹'].unique()),
+                        value=['ALL'],
+                        multi=True,
+                        placeholder="Select Flower Patterns",
+                    ),
+                    dbc.Label('Sizes: '),
+                    dcc.Dropdown(
+                        id='size',
+                        options=dropdown_options(df['尺寸'].unique()),
+                        value=['ALL'],
+                        multi=True,
+                        placeholder="Select Sizes",
+                    ),
+                    dbc.Label('DIMs: '),
+                    dcc.Dropdown(
+                        id='dim',
+                        options=dropdown_options(df['DIM'].unique()),
+                        value=['ALL'],
+                        multi=True,
+                        placeholder="Select DIMs",
+                    ),
+                    dbc.Label('Search SKU or CAI: '),
+                    dcc.Input(
+                        id='search_input',
+                        type='text',
+                        placeholder='Enter SKU or CAI',
+                        # 停止输入半秒后再发给服务器，连续输入不会每个字符都触发一次计算
+                        debounce=0.5,
+                    )
+                ]),
+                html.Div(id='output-container-date-picker-range'),
+                html.Div(id='computing-status'),
+                # 定时检查服务器上的数据版本，换了版本就刷新选项和图表
+                dcc.Interval(id='reload-interval', interval=max(reload_seconds, 1) * 1000, disabled=reload_seconds <= 0),
+                dcc.Store(id='data-version', data=data['version']),
+            ], width=3),
+            dbc.Col([
+                dcc.Graph(id='bar-chart', figure=go.Figure(layout=dict(barmode='group', title_text='全国库存情况'))),
+                dcc.Graph(id='city-bar-chart', figure=go.Figure(layout=dict(barmode='stack', title_text='各城市库存情况'))),
+                dcc.Graph(id='combined-chart', figure=go.Figure(layout=dict(title_text='库存和出库商品数量变化情况'))),
+                # 趋势图的数据只以紧凑的数组发到浏览器，由客户端回调拼成图表
+                dcc.Store(id='combined-data'),
+            ], width=9),
+        ]),
+    ], fluid=True)
+
+
+app.layout = serve_layout
+
+filter_inputs = [Input('start_date', 'date'),
+                 Input('end_date', 'date'),
+                 Input('flower-pattern', 'value'),
+                 Input('size', 'value'),
+                 Input('dim', 'value'),
+                 Input('search_input', 'value'),
+                 Input('data-version', 'data')]
 
+
+def filter_rows(data, start_date, end_date, flower_patterns, sizes, dims, search_input):
+    # 各个图表共用的筛选结果：用明细还是预汇总表、选中的行（连续切片或升序行号），按规范化的筛选条件缓存
+    key = query_key(data['version'], start_date, end_date, flower_patterns, sizes, dims, search_input, 'ALL')
+    selection = cache.get('rows|' + key)
+    if selection is not None:
+        count_cache('rows', 'hit')
+        return selection
+    count_cache('rows', 'miss')
+
+    with stage('filter'):
+        # 没有 SKU/CAI 搜索时用预汇总表，要合并和分组的行数少得多
+        table = 'df' if search_input else 'cube'
+        source, index, time_axis = data[table], data[table + '_index'], data[table + '_axis']
+        start, end = pd.to_datetime(start_date), pd.to_datetime(end_date)
+        lo, hi = date_range_rows(time_axis, start, end)
+        filters = {column: selected for column, selected in zip(dimension_columns, [flower_patterns, sizes, dims])
+                   if 'ALL' not in selected}
+        rows = lookup_rows(index, filters)
         if search_input:
-            search_input = str(search_input)
-            dff = dff[(dff['SKU'].str.contains(search_input)) | (dff['CAI'].str.contains(search_input))]
-
-        summary = dff.groupby('花纹').agg({'全国现货库存': 'sum', '全国采购在途数量': 'sum', '全国昨日出库商品件数': 'sum'})
-        summary.loc['Total'] = summary.sum()
-
-        city_columns = ['北京现货库存', '上海现货库存', '广州现货库存', '成都现货库存', '武汉现货库存', '沈阳现货库存',
-                        '西安现货库存', '德州现货库存']
-        city_summary = dff.groupby('花纹')[city_columns].sum()
-        city_summary.loc['Total'] = city_summary.sum()
-
-        combined_data = dff.groupby('时间').agg({'全国现货库存': 'sum', '全国昨日出库商品件数': 'sum'})
-
-        fig = go.Figure()
-        fig.add_trace(go.Bar(
-            x=summary.index,
-            y=summary['全国现货库存'],
-            name='全国现货库存',
-            text=summary['全国现货库存'],
-            textposition='auto',
-        ))
-        fig.add_trace(go.Bar(
-            x=summary.index,
-            y=summary['全国采购在途数量'],
-            name='全国采购在途数量',
-            text=summary['全国采购在途数量'],
-            textposition='auto',
-        ))
-        fig.add_trace(go.Bar(
-            x=summary.index,
-            y=summary['全国昨日出库商品件数'],
-            name='全国昨日出库商品件数',
-            text=summary['全国昨日出库商品件数'],
-            textposition='auto',
-        ))
-        fig.update_layout(barmode='group', title_text='全国库存情况')
-
-        city_fig = go.Figure()
-        for city in city_columns:
-            city_fig.add_trace(go.Bar(
-                x=city_summary.index,
-                y=city_summary[city],
-                name=city,
-                text=city_summary[city],
-                textposition='auto',
-            ))
-        city_fig.update_layout(barmode='stack', title_text='各城市库存情况')
-
-        combined_fig = go.Figure()
-        combined_fig.add_trace(go.Scatter(
-            x=combined_data.index,
-            y=combined_data['全国现货库存'],
-            name='全国现货库存',
-            mode='lines+markers',
-        ))
-        combined_fig.add_trace(go.Scatter(
-            x=combined_data.index,
-            y=combined_data['全国昨日出库商品件数'],
-            name='全国昨日出库商品件数',
-            mode='lines+markers',
-        ))
-        combined_fig.update_layout(title_text='库存和出库商品数量变化情况')
-
-        return f'Start Date: {start_date} End Date: {end_date}', fig, city_fig, combined_fig
+            matched = search_rows(data['search_index'], str(search_input))
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        if rows is None:
+            rows = slice(lo, hi)
+        else:
+            rows = rows[np.searchsorted(rows, lo):np.searchsorted(rows, hi)]
+        all_dates = data['all_dates']
+        selection = {'source': source, 'rows': rows, 'key': key, 'groups': data[table + '_groups'],
+                     'calendar': all_dates[(all_dates >= start) & (all_dates <= end)]}
+        count_rows(len(source), len(source.index[rows]))
+    cache.set('rows|' + key, selection)
+    return selection
+
+
+def cached_result(name, build, data, *filters):
+    # 每个图表的结果放在各进程共用的缓存里，同一个结果同时只有一个进程在算
+    key = name + '|' + query_key(data['version'], *filters, 'ALL')
+
+    def compute():
+        selection = filter_rows(data, *filters)
+        with stage('figure'):
+            return build(selection)
+
+    return single_flight(shared_cache, key, compute)
+
+
+def patch_traces(name, build_traces, data, *filters):
+    # 图表的布局在页面里只发一次，筛选变化时只替换 data
+    patched = Patch()
+    try:
+        patched['data'] = cached_result(name, build_traces, data, *filters)
+    except Exception:
+        patched['data'] = []
+    return patched
+
+
+def typed_array(values):
+    # 数值列编码成小端定长数组的 base64，比逐个数字的 JSON 短，浏览器端直接还原成 TypedArray
+    values = np.asarray(values)
+    if values.dtype.kind in 'iub' and (values.size == 0 or (values.min() >= -2 ** 31 and values.max() < 2 ** 31)):
+        return {'dtype': 'i4', 'bdata': base64.b64encode(values.astype('<i4').tobytes()).decode('ascii')}
+    return {'dtype': 'f8', 'bdata': base64.b64encode(values.astype('<f8').tobytes()).decode('ascii')}
+
+
+# 按花纹的所有度量一次算完，两个柱状图共用；按日期的度量另算一次
+pattern_measures = ['全国现货库存', '全国采购在途数量', '全国昨日出库商品件数'] + city_columns
+date_measures = ['全国现货库存', '全国昨日出库商品件数']
+
+
+def bar_traces(selection):
+    columns = ['全国现货库存', '全国采购在途数量', '全国昨日出库商品件数']
+    summary = grouped(cache, selection, '花纹', pattern_measures)[columns].copy()
+    summary.loc['Total'] = summary.sum()
+    return [go.Bar(x=summary.index, y=summary[column], name=column, text=summary[column], textposition='auto')
+            for column in columns]
+
+
+def city_traces(selection):
+    city_summary = grouped(cache, selection, '花纹', pattern_measures)[city_columns].copy()
+    city_summary.loc['Total'] = city_summary.sum()
+    return [go.Bar(x=city_summary.index, y=city_summary[city], name=city, text=city_summary[city], textposition='auto')
+            for city in city_columns]
+
+
+def combined_series(selection):
+    # 日历是连续的，日期只发第一天的 epoch 天数，浏览器按下标往后推；每个度量一个定长数组
+    calendar = selection['calendar']
+    combined_data = grouped(cache, selection, '时间', date_measures).reindex(calendar, fill_value=0)
+    first_day = int(calendar[0].value // (86400 * 10 ** 9)) if len(calendar) else 0
+    return {'first_day': first_day, 'length': len(calendar), 'names': date_measures,
+            'values': [typed_array(combined_data[column].to_numpy()) for column in date_measures]}
+
+
+@app.callback(Output('output-container-date-picker-range', 'children'), filter_inputs, prevent_initial_call=True)
+@instrumented
+def update_output(start_date, end_date, flower_patterns, sizes, dims, search_input, version=None):
+    # 标题只检查筛选条件，直接在请求线程里返回；筛选和分组在图表的回调里做
+    try:
+        query_key(dataset['version'], start_date, end_date, flower_patterns, sizes, dims, search_input, 'ALL')
     except Exception as e:
-        return str(e), {}, {}, {}
+        return str(e)
+    return f'Start Date: {start_date} End Date: {end_date}'
+
+
+# 三个图表在一个回调里算完：放到后台时每次操作只 fork 一个任务进程，筛选结果和按花纹的分组在这个进程里只算一次
+@app.callback(Output('bar-chart', 'figure'),
+              Output('city-bar-chart', 'figure'),
+              Output('combined-data', 'data'),
+              filter_inputs, prevent_initial_call=True,
+              **background_options(manager, (Output('computing-status', 'children'), '正在计算图表…', ''),
+                                   dimmed('bar-chart'), dimmed('city-bar-chart'), dimmed('combined-chart')))
+@instrumented
+def update_charts(start_date, end_date, flower_patterns, sizes, dims, search_input, version=None):
+    # 开始时取一次 dataset 引用，中途换了新版本这次回调也用旧版本算完
+    data = dataset
+    filters = (start_date, end_date, flower_patterns, sizes, dims, search_input)
+    # 趋势图服务器只算按日汇总的数组，不再生成和校验整个 Plotly 图表
+    try:
+        combined = cached_result('combined', combined_series, data, *filters)
+    except Exception:
+        combined = None
+    return patch_traces('bar', bar_traces, data, *filters), patch_traces('city', city_traces, data, *filters), combined
+
+
+# 在浏览器里把紧凑数组还原成折线图，保留图表原来的布局
+app.clientside_callback(
+    """
+    function(series, figure) {
+        var traces = [];
+        if (series) {
+            var x = [];
+            for (var i = 0; i < series.length; i++) {
+                x.push(new Date((series.first_day + i) * 86400000).toISOString().slice(0, 10));
+            }
+            traces = series.names.map(function(name, k) {
+                var column = series.values[k];
+                var bytes = Uint8Array.from(atob(column.bdata), function(c) { return c.charCodeAt(0); });
+                var y = column.dtype === 'i4' ? new Int32Array(bytes.buffer) : new Float64Array(bytes.buffer);
+                return {type: 'scatter', mode: 'lines+markers', name: name, x: x, y: Array.from(y)};
+            });
+        }
+        return Object.assign({}, figure, {data: traces});
+    }
+    """,
+    Output('combined-chart', 'figure'),
+    Input('combined-data', 'data'),
+    State('combined-chart', 'figure'),
+    prevent_initial_call=True,
+)
+
+
+@app.callback(Output('data-version', 'data'),
+              Output('flower-pattern', 'options'),
+              Output('size', 'options'),
+              Output('dim', 'options'),
+              Output('start_date', 'min_date_allowed'),
+              Output('start_date', 'max_date_allowed'),
+              Output('end_date', 'min_date_allowed'),
+              Output('end_date', 'max_date_allowed'),
+              Input('reload-interval', 'n_intervals'),
+              State('data-version', 'data'),
+              prevent_initial_call=True)
+@instrumented
+def refresh_options(n_intervals, version):
+    # 服务器换了数据版本时更新已打开页面的下拉选项和日期范围；data-version 变了也会触发各图表重算
+    data = dataset
+    if data['version'] == version:
+        raise PreventUpdate
+    df = data['df']
+    first, last = df['时间'].min(), df['时间'].max()
+    return (data['version'], dropdown_options(df['花纹'].unique()), dropdown_options(df['尺寸'].unique()),
+            dropdown_options(df['DIM'].unique()), first, last, first, last)
+
+
+def reload_dataset():
+    # 发现更新的数据文件（换了日期，或者 ETL 重写了当天的文件）时，在后台读好、建好索引，再一次性替换 dataset；
+    # 正在执行的回调拿的是旧引用，照常算完；缓存键里有数据版本，旧版本的缓存项不会再被命中，这里直接清掉
+    global dataset
+    new_file = find_data_file(data_dir, data_prefix)
+    if new_file == dataset['path'] and data_version(new_file) == dataset['version']:
+        return False
+    dataset = load_dataset(new_file)
+    cache.clear()
+    logging.info('已切换到新数据 %s（版本 %s）', os.path.basename(new_file), dataset['version'])
+    return True
+
+
+def watch_data_files():
+    while True:
+        time.sleep(reload_seconds)
+        try:
+            reload_dataset()
+        except Exception:
+            # ETL 还在写文件时可能读到不完整的数据，继续用当前版本，下次再试
+            logging.exception('重新加载数据失败，继续使用当前版本')
+
 
-    def update_output(start_date, end_date, flower_patterns, sizes, dims, search_input):
-        ...
-        # Rest of your function
+if reload_seconds > 0:
+    threading.Thread(target=watch_data_files, name='data-watcher', daemon=True).start()
 
 if __name__ == "__main__":
     app.run_server(debug=True)
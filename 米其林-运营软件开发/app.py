@@ -0,0 +1,206 @@
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import logging
+import threading
+import importlib.util
+
+from werkzeug.serving import make_server
+
+# 生产环境入口（Procfile：web: python app.py），代替看板脚本末尾的 app.run_server(debug=True)：
+# 主进程只读一次数据、建好索引，再 fork 出多个工作进程，工作进程通过写时复制共用主进程里的数据，
+# 各自多线程处理请求，多个用户同时操作时不用排在同一个回调后面。Windows 没有 fork，退回单进程多线程。
+#   kill -HUP <主进程>   平滑重启：先换上最新的数据，再逐个替换工作进程
+#   kill -TERM <主进程>  停止：工作进程处理完手头的请求后退出
+#   /healthz 存活检查，/readyz 就绪检查（排空中返回 503，正常时返回进程号和数据版本）
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+root = os.path.dirname(os.path.abspath(__file__))
+# 要运行的看板脚本，默认是销售看板，库存看板可以用 MQL_DASHBOARD 指定
+dashboard_file = os.environ.get('MQL_DASHBOARD', os.path.join(root, '运营软件开发-V9.py'))
+host = os.environ.get('HOST', '0.0.0.0')
+port = int(os.environ.get('PORT', 8050))
+workers = int(os.environ.get('MQL_WORKERS', os.cpu_count() or 1))
+# 工作进程退出前最多等多久让正在处理的请求完成（秒）
+graceful_seconds = int(os.environ.get('MQL_GRACEFUL_SECONDS', 30))
+# 多久检查一次有没有新的数据文件（秒），0 表示不检查。多进程时由主进程检查，看板脚本自己不起后台线程
+# （fork 出来的子进程里没有这个线程，各自加载新数据也会失去写时复制的共享）
+reload_seconds = int(os.environ.get('MQL_RELOAD_SECONDS', 60))
+os.environ['MQL_RELOAD_SECONDS'] = '0'
+
+# 工作进程的状态：是否在排空，正在处理的请求数
+draining = threading.Event()
+requests_done = threading.Condition()
+active_requests = 0
+
+
+def load_dashboard(path):
+    # 按文件路径导入看板脚本（文件名不是合法的模块名）；模块要登记在 sys.modules 里，Flask 才能按模块名找到脚本所在的目录
+    spec = importlib.util.spec_from_file_location('dashboard', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['dashboard'] = module
+    spec.loader.exec_module(module)
+    # 页面里定时检查数据版本的间隔跟着真正的检查间隔走
+    module.reload_seconds = reload_seconds
+    return module
+
+
+def track_requests(wsgi_app):
+    # 记录正在处理的请求数，排空时等它们完成
+    def tracked(environ, start_response):
+        global active_requests
+        with requests_done:
+            active_requests += 1
+        try:
+            response = wsgi_app(environ, start_response)
+            try:
+                yield from response
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+        finally:
+            with requests_done:
+                active_requests -= 1
+                requests_done.notify_all()
+
+    return tracked
+
+
+def add_health_routes(module):
+    server = module.app.server
+
+    @server.route('/healthz')
+    def healthz():
+        return 'ok'
+
+    @server.route('/readyz')
+    def readyz():
+        if draining.is_set():
+            return 'draining', 503
+        dataset = getattr(module, 'dataset', None)
+        return {'pid': os.getpid(), 'version': dataset['version'] if dataset else None}
+
+
+def run_worker(module, listener):
+    # 在继承来的监听 socket 上多线程处理请求；收到 SIGTERM/SIGINT 后不再接新连接，等正在处理的请求完成再返回
+    server = make_server(host, port, track_requests(module.app.server), threaded=True, fd=listener.fileno())
+
+    def stop(signum, frame):
+        draining.set()
+        # shutdown 会等 serve_forever 结束，不能在 serve_forever 所在的主线程里直接调用
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    with requests_done:
+        requests_done.wait_for(lambda: active_requests == 0, timeout=graceful_seconds)
+
+
+def spawn_worker(module, listener):
+    pid = os.fork()
+    if pid == 0:
+        # 平滑重启只由主进程处理
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        code = 0
+        try:
+            run_worker(module, listener)
+        except Exception:
+            logging.exception('工作进程 %d 异常退出', os.getpid())
+            code = 1
+        # os._exit 不执行 atexit，退出前写入这个进程还没写入的监控指标
+        shared = sys.modules.get('看板公共')
+        if shared is not None:
+            shared.flush_metrics()
+        os._exit(code)
+    logging.info('启动工作进程 %d', pid)
+    return pid
+
+
+def restart_workers(module, listener, children, retiring):
+    # 平滑重启：逐个 fork 新的工作进程（带着主进程里当前的数据），再让旧的处理完手头的请求后退出；
+    # 监听 socket 是共用的，替换过程中始终有进程在接请求
+    gc.freeze()
+    replaced = set()
+    for pid in children:
+        replaced.add(spawn_worker(module, listener))
+        os.kill(pid, signal.SIGTERM)
+        retiring.add(pid)
+    return replaced
+
+
+def reload_data(module):
+    # 主进程里加载更新的数据文件，换了版本返回 True；没有新数据（只看文件名和 stat）或加载失败时返回 False
+    if not hasattr(module, 'reload_dataset'):
+        return False
+    try:
+        return module.reload_dataset()
+    except Exception:
+        logging.exception('重新加载数据失败，继续使用当前版本')
+        return False
+
+
+def serve_forked(module, listener):
+    state = {'stop': False, 'restart': False}
+
+    def on_stop(signum, frame):
+        state['stop'] = True
+
+    def on_restart(signum, frame):
+        state['restart'] = True
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_restart)
+
+    # 已有的对象移到永久代：子进程里的垃圾回收不再扫描（改写）这些对象所在的页，写时复制能共享得更久
+    gc.freeze()
+    children = {spawn_worker(module, listener) for _ in range(workers)}
+    retiring = set()
+    last_check = time.monotonic()
+    while not state['stop']:
+        # 回收退出的工作进程；不是重启或停止引起的退出就补一个
+        while True:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            if pid in retiring:
+                retiring.discard(pid)
+            elif pid in children:
+                children.discard(pid)
+                logging.warning('工作进程 %d 意外退出（状态 %d），重新启动', pid, status)
+                children.add(spawn_worker(module, listener))
+
+        # 收到 SIGHUP 时总是重启；定时检查只在数据换了版本时重启
+        check_due = reload_seconds > 0 and time.monotonic() - last_check >= reload_seconds
+        if state['restart'] or check_due:
+            last_check = time.monotonic()
+            if reload_data(module) or state['restart']:
+                children = restart_workers(module, listener, children, retiring)
+            state['restart'] = False
+        time.sleep(1)
+
+    for pid in children | retiring:
+        os.kill(pid, signal.SIGTERM)
+    for pid in children | retiring:
+        os.waitpid(pid, 0)
+    logging.info('已停止')
+
+
+if __name__ == '__main__':
+    module = load_dashboard(dashboard_file)
+    add_health_routes(module)
+    listener = socket.create_server((host, port), backlog=128)
+    listener.set_inheritable(True)
+    logging.info('%s 已加载，监听 http://%s:%d', os.path.basename(dashboard_file), host, port)
+    if hasattr(os, 'fork') and workers > 1:
+        serve_forked(module, listener)
+    else:
+        # 单进程：由看板脚本自己的后台线程检查新数据
+        if reload_seconds > 0 and hasattr(module, 'watch_data_files'):
+            threading.Thread(target=module.watch_data_files, name='data-watcher', daemon=True).start()
+        run_worker(module, listener)
@@ -0,0 +1,326 @@
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import logging
+import pandas as pd
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+# 库存和销售两个数据处理脚本（V2）共用的增量导入代码：文件清单、并行/流式读取、(时间, SKU) 键索引去重、
+# 字典编译、列式快照和预汇总表。和 看板公共.py 分开放，数据处理脚本不用装 flask/dash 也能运行。
+# 各脚本自己的文件路径、cube 的维度和度量都作为参数传进来
+
+# 累计历史的格式版本：历史里存的内容变了时加一，旧格式的文件按全量重建处理。
+# 3：累计历史只存去重并筛选后的行（以前存筛选前的行），键索引里仍有被筛掉的行的键
+history_format = 3
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_entry(path, old_entry=None):
+    # 大小和修改时间都没变时沿用清单里的哈希，不再读取整个文件
+    st = os.stat(path)
+    if old_entry and old_entry['size'] == st.st_size and old_entry['mtime'] == st.st_mtime_ns:
+        return old_entry
+    return {'path': path, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': file_hash(path)}
+
+
+def load_manifest(manifest_file, history_file, key_index_file):
+    # 清单、累计历史和键索引必须同时存在，否则按第一次运行处理
+    if os.path.exists(manifest_file) and os.path.exists(history_file) and os.path.exists(key_index_file):
+        with open(manifest_file, encoding='utf-8') as f:
+            return json.load(f)
+    return {'template': None, 'files': {}}
+
+
+def save_manifest(manifest, manifest_file):
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, manifest_file)
+
+
+def read_export(path, usecols=None):
+    # 在子进程中读取单个文件，同时返回耗时；usecols 为 None 时读全部列
+    start = time.perf_counter()
+    df = pd.read_excel(path, usecols=None if usecols is None else lambda name: name in usecols)
+    return df, time.perf_counter() - start
+
+
+def iter_export_chunks(path, usecols=None, chunk_rows=50000):
+    # 用 openpyxl 只读模式逐行读取，只保留 usecols 中的列（None 表示全部列），每攒够 chunk_rows 行输出一个带类型的 DataFrame。
+    # 这里不筛选行：被筛掉的行也要先参与 (时间, SKU) 去重，筛选由调用方在去重之后做
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        keep = [i for i, name in enumerate(header) if name is not None and (usecols is None or name in usecols)]
+        columns = [header[i] for i in keep]
+
+        buffer = []
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            buffer.append([row[i] if i < len(row) else None for i in keep])
+            if len(buffer) >= chunk_rows:
+                yield pd.DataFrame(buffer, columns=columns).infer_objects()
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns).infer_objects()
+    finally:
+        wb.close()
+
+
+def iter_exports(paths, workers=1, usecols=None, stream_threshold_mb=float('inf'), chunk_rows=50000):
+    # 按文件顺序逐块产出导出数据，调用方边读边去重，不用先把所有文件拼成一个大表：
+    # 不超过 stream_threshold_mb 的文件整份交给进程池并行解析；更大的文件在主进程里流式读取，
+    # 每块 chunk_rows 行，峰值内存只和每块行数有关，与文件大小无关
+    stream = [os.path.getsize(path) > stream_threshold_mb * 1024 * 1024 for path in paths]
+    small = [path for path, big in zip(paths, stream) if not big]
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(small))) if workers > 1 and len(small) > 1 else None
+    try:
+        futures = {path: pool.submit(read_export, path, usecols) for path in small} if pool else {}
+        for path, big in zip(paths, stream):
+            if big:
+                start, rows = time.perf_counter(), 0
+                for chunk in iter_export_chunks(path, usecols, chunk_rows):
+                    rows += len(chunk)
+                    yield chunk
+                logging.info('流式读取 %s：%d 行，%.2f 秒', os.path.basename(path), rows, time.perf_counter() - start)
+                continue
+            df, seconds = futures.pop(path).result() if pool else read_export(path, usecols)
+            logging.info('读取 %s：%d 行，%.2f 秒', os.path.basename(path), len(df), seconds)
+            yield df
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+
+def arrow_ready(df):
+    # 整理成可以写成 Arrow 的带类型表：时间列转成日期时间，
+    # Excel 里同一列混有数字和文字时（例如 SKU、尺寸），统一转成文字，空值保持为空
+    df = df.reset_index(drop=True)
+    df['时间'] = pd.to_datetime(df['时间'])
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True) in ('mixed', 'mixed-integer'):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def narrow_measures(df, measures):
+    # 度量列都是整数值且没有空值时转成能装下的最窄整数，带小数或空值的浮点列保持 float64，求和不丢精度。
+    # 在写快照和预汇总表时就收窄，看板直接映射使用，不用加载后再转换（转换会把映射的内存复制一份）
+    for column in measures:
+        if column not in df.columns or df[column].dtype.kind not in 'iuf':
+            continue
+        values = df[column]
+        if values.dtype.kind == 'f':
+            if values.isna().any() or not (values == np.floor(values)).all():
+                continue
+            values = values.astype('int64')
+        df[column] = pd.to_numeric(values, downcast='integer')
+    return df
+
+
+def write_arrow(df, file):
+    # 写成不压缩的 Arrow IPC 文件（Feather V2 格式），看板直接内存映射；先写临时文件再原子替换
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # 浮点列里的 NaN 按数值保存而不是转成 null，读取时这些列可以直接引用映射的内存
+    for i, col in enumerate(df.columns):
+        if df[col].dtype.kind == 'f':
+            table = table.set_column(i, col, pa.array(df[col].to_numpy(), from_pandas=False))
+    # 整张表写成一个记录批次，读取时每列是一段连续内存
+    with pa.OSFile(file + '.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=max(len(table), 1))
+    os.replace(file + '.tmp', file)
+
+
+def snapshot_version():
+    # 快照和预汇总表共用的版本号，写在文件名里（path 同名的 .版本号.feather 和 .版本号-cube.feather）
+    return datetime.now().strftime('%H%M%S%f')
+
+
+def write_snapshot(df, path, version, measures):
+    # 同时写出带类型的列式快照，看板启动时直接内存映射，不用再解析整个Excel。
+    # 同一版本的预汇总表要先由 write_cube 写好：快照写完后最后才原子替换指针文件（path.current），
+    # 看板只按指针切换版本，快照和预汇总表总是一起换；正在映射旧版本的看板进程不受影响
+    stem = os.path.splitext(path)[0]
+    pointer_file = stem + '.current'
+    # 结果文件名末尾是日期（例如 米其林库存监测表—20231018），同一前缀的各天快照一起管理
+    snapshot_dir, name = os.path.split(stem)
+    dated = re.fullmatch(r'(.*?)\d{8}', name)
+    day_pattern = re.escape(dated.group(1)) + r'\d{8}' if dated else re.escape(name)
+    pointers = sorted(filename for filename in os.listdir(snapshot_dir or '.')
+                      if re.fullmatch(day_pattern + r'\.current', filename))
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logging.warning('未安装 pyarrow，跳过列式快照 %s', path)
+        # 旧指针指向的是以前的结果，看板有指针时优先用有指针的日期，留着会一直用它，删掉后改读这次的Excel
+        for filename in pointers:
+            os.remove(os.path.join(snapshot_dir, filename))
+        return
+    # 按时间排好序再写，看板按日期范围取行时直接二分查找切片；measures 里的度量列收窄成最窄的整数
+    snapshot = arrow_ready(df).sort_values('时间', kind='stable', ignore_index=True)
+    snapshot = narrow_measures(snapshot, measures)
+    # 上一个版本：今天已有指针时是它指向的版本，否则是最近一天的指针指向的版本（看板换到今天之前还在用它）
+    previous_pointer = os.path.basename(pointer_file) if os.path.basename(pointer_file) in pointers else \
+        (pointers[-1] if pointers else None)
+    previous_file = None
+    if previous_pointer:
+        with open(os.path.join(snapshot_dir, previous_pointer), encoding='utf-8') as f:
+            previous_file = f.read().strip()
+    snapshot_file = stem + '.' + version + '.feather'
+    write_arrow(snapshot, snapshot_file)
+    with open(pointer_file + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(os.path.basename(snapshot_file))
+    os.replace(pointer_file + '.tmp', pointer_file)
+
+    # 清理同一前缀各天更早版本的快照、预汇总表和以前各天的指针，只留这次的版本和上一个版本（给刚读到旧指针的进程）；
+    # 仍被映射的文件（Windows）下次再删
+    keep = {os.path.basename(pointer_file)}
+    for kept_file in [os.path.basename(snapshot_file), previous_file]:
+        if kept_file:
+            keep |= {kept_file, kept_file[:-len('.feather')] + '-cube.feather'}
+    for filename in os.listdir(snapshot_dir or '.'):
+        if filename in keep or not re.fullmatch(day_pattern + r'(\.\d+(-cube)?\.feather|\.current)', filename):
+            continue
+        try:
+            os.remove(os.path.join(snapshot_dir, filename))
+        except OSError:
+            pass
+
+
+def sku_strings(values):
+    # SKU 统一成文字再比较；SKU 列有空值时 Excel 会读成浮点数，先转回整数，避免 '123.0' 和 '123' 对不上
+    if values.dtype.kind == 'f':
+        values = values.astype('Int64')
+    return values.astype(str).to_numpy()
+
+
+def new_generation():
+    # 每次保存累计历史时的新代号，同时写进累计历史、键索引和清单，读取时三份对得上才算同一次写入的
+    return uuid.uuid4().hex
+
+
+def save_history(history_df, generation, history_file):
+    tmp_file = history_file + '.tmp'
+    pd.to_pickle({'generation': generation, 'rows': history_df}, tmp_file)
+    os.replace(tmp_file, history_file)
+
+
+def load_key_index(key_index_file):
+    with np.load(key_index_file) as data:
+        return str(data['generation']), pd.Index(data['skus'], dtype=object), data['keys'], data['row_codes']
+
+
+def save_key_index(skus, keys, row_codes, generation, key_index_file):
+    tmp_file = key_index_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, generation=generation, skus=np.asarray(skus, dtype=str), keys=keys, row_codes=row_codes)
+    os.replace(tmp_file, key_index_file)
+
+
+def load_history(manifest, history_file, key_index_file):
+    # 读取上次的累计历史和键索引。三份文件各自原子替换，但上次在三份都写完之前被中断时会新旧混在一起：
+    # 格式版本、代号和行数都对得上才用，否则返回 None，由调用方全量重建
+    if manifest.get('format') != history_format:
+        return None
+    try:
+        history = pd.read_pickle(history_file)
+        generation, skus, keys, row_codes = load_key_index(key_index_file)
+    except Exception:
+        logging.exception('读取累计历史失败，全量重建')
+        return None
+    history_df = history['rows']
+    if (history['generation'] != manifest['generation'] or generation != manifest['generation']
+            or not len(history_df) == len(row_codes) == manifest['rows']):
+        logging.warning('累计历史、键索引和清单不是同一次写入的（上次可能中途被中断），全量重建')
+        return None
+    return history_df, skus, keys, row_codes
+
+
+def probe_keys(df, skus, keys):
+    # 把 (时间, SKU) 打包成一个 int64：高位是日期（距 1970-01-01 的天数），低 32 位是 SKU 在词表中的编号。
+    # 只对新行做：批内按 keep='first' 去重，再在排好序的历史键里二分查找去掉已有的键，不用重新哈希整个历史。
+    # 返回新行中要保留的行、每行的 SKU 编号、追加了新 SKU 的词表和合并后的键
+    sku_values = sku_strings(df['SKU'])
+    unseen = skus.get_indexer(sku_values) < 0
+    if unseen.any():
+        skus = skus.append(pd.Index(pd.unique(sku_values[unseen]), dtype=object))
+    codes = skus.get_indexer(sku_values).astype(np.int64)
+    times = pd.to_datetime(df['时间'])
+    days = times.to_numpy().astype('datetime64[D]').astype(np.int64)
+    days[times.isna().to_numpy()] = -1 << 30
+    new_keys = (days << 32) | codes
+
+    is_new = ~pd.Series(new_keys).duplicated(keep='first').to_numpy()
+    if len(keys):
+        pos = np.minimum(np.searchsorted(keys, new_keys), len(keys) - 1)
+        is_new &= keys[pos] != new_keys
+    # 只给新键排序，再按二分查找的位置并进已排好序的历史键，不用每块都把整个历史重新排一遍
+    added = np.sort(new_keys[is_new])
+    keys = np.insert(keys, np.searchsorted(keys, added), added)
+    return is_new, codes, skus, keys
+
+
+def compile_dictionary(dictionary_df, cache_file):
+    # 把字典表编译成整数编码的查找表：SKU 词表 + 每个属性一个分类数组（编码 + 类别）。
+    # 字典表内容不变时直接用磁盘上的缓存 cache_file；同一个 SKU 出现多次时取第一条
+    columns = ['CAI', '花纹', '尺寸', 'DIM']
+    entries = dictionary_df[['SKU'] + columns]
+    digest = hashlib.sha256(pd.util.hash_pandas_object(entries, index=False).to_numpy().tobytes()).hexdigest()
+    if os.path.exists(cache_file):
+        compiled = pd.read_pickle(cache_file)
+        if compiled['hash'] == digest:
+            return compiled
+
+    sku_values = sku_strings(entries['SKU'])
+    first = ~pd.Series(sku_values).duplicated(keep='first').to_numpy()
+    entries = entries[first]
+    compiled = {
+        'hash': digest,
+        'skus': pd.Index(sku_values[first], dtype=object),
+        'attributes': {col: pd.Categorical(entries[col]) for col in columns},
+    }
+    pd.to_pickle(compiled, cache_file + '.tmp')
+    os.replace(cache_file + '.tmp', cache_file)
+    return compiled
+
+
+def enrich(df, row_codes, skus, dictionary):
+    # 字典行号只按 SKU 词表匹配一次（不同 SKU 的个数），每一行只按 SKU 编号做整数取值，不再逐行哈希 SKU 字符串
+    dictionary_rows = dictionary['skus'].get_indexer(skus)[row_codes]
+    for col, values in dictionary['attributes'].items():
+        # 词表末尾补一个 -1，字典里没有的 SKU（行号 -1）取到的就是空值
+        codes = np.append(values.codes, -1)[dictionary_rows]
+        df[col] = pd.api.extensions.take(values.categories.to_numpy(), codes, allow_fill=True)
+    return df
+
+
+def write_cube(df, path, version, dimensions, measures):
+    # 按 dimensions（时间, 花纹, 尺寸, DIM）预先汇总可加的度量 measures，写成和快照同一版本的 path 同名 .版本号-cube.feather，
+    # 要在 write_snapshot 替换指针之前写好；看板在没有 SKU/CAI 搜索时直接用这张比明细小得多的表做分组
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logging.warning('未安装 pyarrow，跳过预汇总表 %s', path)
+        return
+    cube = arrow_ready(df).groupby(dimensions, dropna=False, sort=False)[measures].sum().reset_index()
+    cube = narrow_measures(cube.sort_values('时间', kind='stable', ignore_index=True), measures)
+    cube_file = os.path.splitext(path)[0] + '.' + version + '-cube.feather'
+    write_arrow(cube, cube_file)
+    logging.info('预汇总表 %s：%d 行（明细 %d 行）', os.path.basename(cube_file), len(cube), len(df))
@@ -0,0 +1,719 @@
+import os
+import re
+import json
+import time
+import atexit
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+import functools
+import contextlib
+import contextvars
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import flask
+from dash.dependencies import Output
+from flask_caching.backends.base import BaseCache
+
+# 库存看板（库存软件开发-V8-GPT优化.py）、销售看板（运营软件开发-V9.py）和对比看板（运营软件开发-V10-对比.py）共用的代码：
+# 读取快照和预汇总表、压缩列类型、按时间切片、倒排索引和搜索、分组求和、结果缓存、后台任务和监控指标。
+# 和 app.py 放在同一个目录；各看板把这个目录加到 sys.path 后按名字导入，缓存后端也按 看板公共.类名 找到
+
+
+def read_snapshot(snapshot_file):
+    # 只读内存映射 Arrow 快照：多个看板进程映射同一个文件，共用操作系统的页缓存，
+    # 没有空值的数值列和时间列直接引用映射的内存，每个进程不再各自复制一份
+    import pyarrow as pa
+    table = pa.ipc.open_file(pa.memory_map(snapshot_file, 'r')).read_all()
+    return table.to_pandas(split_blocks=True)
+
+
+def current_snapshot(path):
+    # ETL 把快照和同一版本的预汇总表都写好后才替换指针文件（path 同名的 .current），指针在就以它指向的快照为准；
+    # 没有指针（没装 pyarrow 的 ETL）时返回 None，读Excel
+    pointer_file = os.path.splitext(path)[0] + '.current'
+    try:
+        with open(pointer_file, encoding='utf-8') as f:
+            return os.path.join(os.path.dirname(path), f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def load_data(path, snapshot_file):
+    # 有列式快照时直接内存映射，不用再解析整个Excel
+    if snapshot_file is not None:
+        return read_snapshot(snapshot_file)
+    return pd.read_excel(path, sheet_name='原始数据')
+
+
+def load_cube(snapshot_file, df):
+    # ETL 按 (时间, 花纹, 尺寸, DIM) 预先汇总好的表，和快照同一个版本（快照名加 -cube），没有 SKU/CAI 搜索时用它分组；
+    # 读Excel或者这个版本没有预汇总表时直接用明细，不会拿别的版本的预汇总表配这份明细
+    if snapshot_file is not None:
+        cube_file = os.path.splitext(snapshot_file)[0] + '-cube.feather'
+        if os.path.exists(cube_file):
+            return read_snapshot(cube_file)
+    return df
+
+
+def compact(table, schema, name):
+    # 按 schema 压缩列类型：维度列转成 category（类别按 groupby 的排序排列，分组结果的顺序不变）。
+    # 整数度量列 ETL 写快照时已经收窄，直接用映射的内存，这里不再转换（转换会复制一份）；
+    # 整数值且没有空值的浮点度量列（读 Excel 时，或者看板自己算的销售利润）转成能装下的最窄整数，其余保持 float64
+    before = table.memory_usage(deep=True).sum()
+    for column, kind in schema.items():
+        if column not in table.columns:
+            continue
+        values = table[column]
+        if kind == 'category' and not isinstance(values.dtype, pd.CategoricalDtype):
+            categories = values.groupby(values, sort=True).size().index
+            table[column] = pd.Categorical(values, categories=categories)
+        elif kind == 'measure' and values.dtype.kind == 'f':
+            if values.isna().any() or not (values == np.floor(values)).all():
+                continue
+            table[column] = pd.to_numeric(values.astype('int64'), downcast='integer')
+    after = table.memory_usage(deep=True).sum()
+    logging.info('%s 列类型压缩：%.1f MB -> %.1f MB，节省 %.1f MB', name, before / 2 ** 20, after / 2 ** 20,
+                 (before - after) / 2 ** 20)
+    return table
+
+
+def sort_by_time(table):
+    # 按时间排好序（ETL 写出的快照和预汇总表已经排好，这时直接返回，不复制）
+    if table['时间'].is_monotonic_increasing:
+        return table
+    return table.sort_values('时间', kind='stable', ignore_index=True)
+
+
+def build_time_axis(table):
+    # table 已按时间排序：不同的日期，以及每个日期第一行的位置（最后再加上总行数）
+    times = table['时间'].to_numpy()
+    dates, offsets = np.unique(times, return_index=True)
+    return dates, np.append(offsets, len(times))
+
+
+def date_range_rows(time_axis, start_date, end_date):
+    # 两次二分查找得到 [start_date, end_date] 对应的行范围 [lo, hi)
+    dates, offsets = time_axis
+    lo = offsets[np.searchsorted(dates, np.datetime64(start_date), side='left')]
+    hi = offsets[np.searchsorted(dates, np.datetime64(end_date), side='right')]
+    return lo, hi
+
+
+def build_groups(table, time_axis):
+    # 分组用的整数编码：花纹用 category 的编码（空值是 -1），时间用排好序后每行的日期序号
+    dates, offsets = time_axis
+    return {
+        '花纹': (table['花纹'].cat.codes.to_numpy().astype(np.intp), table['花纹'].cat.categories),
+        '时间': (np.repeat(np.arange(len(dates)), np.diff(offsets)), pd.DatetimeIndex(dates)),
+    }
+
+
+def group_sums(selection, column, measures):
+    # 融合的分组求和：选中行的所有度量排成一个矩阵，用 (分组编码, 度量序号) 组成的下标只做一次 bincount；
+    # 空值按 0 加，没有行的分组不出现，和 groupby(observed=True).sum() 的结果一致
+    source, rows = selection['source'], selection['rows']
+    codes, labels = selection['groups'][column]
+    codes = codes[rows]
+    values = source.iloc[rows, source.columns.get_indexer(measures)].to_numpy(dtype='float64', na_value=0)
+    keep = codes >= 0
+    if not keep.all():
+        codes, values = codes[keep], values[keep]
+    width = len(measures)
+    flat = (codes[:, None] * width + np.arange(width)).ravel()
+    sums = np.bincount(flat, weights=values.ravel(), minlength=len(labels) * width).reshape(len(labels), width)
+    counts = np.bincount(codes, minlength=len(labels))
+    result = pd.DataFrame(sums, index=labels, columns=measures)[counts > 0]
+    for measure in measures:
+        if source[measure].dtype.kind in 'iub':
+            result[measure] = result[measure].astype('int64')
+    result.index.name = column
+    return result
+
+
+
+def grouped(cache, selection, column, measures):
+    # 同一次筛选的几个图表共用按 column 分组的结果，按筛选条件缓存在本进程的 cache 里
+    key = 'group|%s|%s|%s' % (column, ','.join(measures), selection['key'])
+    result = cache.get(key)
+    if result is not None:
+        count_cache('group', 'hit')
+        return result
+    count_cache('group', 'miss')
+    with stage('groupby'):
+        result = group_sums(selection, column, measures)
+    cache.set(key, result)
+    return result
+
+
+def build_index(table, columns):
+    # 倒排索引：每个筛选列的 值 -> 升序行号数组，加载时建一次
+    index = {}
+    for column in columns:
+        codes, values = pd.factorize(table[column])
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+        index[column] = {value: order[bounds[i]:bounds[i + 1]] for i, value in enumerate(values)}
+    return index
+
+
+def lookup_rows(index, filters):
+    # filters 是 {列: 选中的值}，同一列的值取并集、不同列之间取交集，返回升序行号；没有条件时返回 None 表示全部行
+    rows = None
+    for column, selected in filters.items():
+        matched = [index[column][value] for value in selected if value in index[column]]
+        column_rows = np.unique(np.concatenate(matched)) if matched else np.empty(0, dtype=np.intp)
+        rows = column_rows if rows is None else np.intersect1d(rows, column_rows, assume_unique=True)
+    return rows
+
+
+def build_search_index(table, columns):
+    # SKU/CAI 搜索索引：只对不同的字符串建三元组倒排表（三元组 -> 字符串编号），每个字符串编号再对应升序行号
+    strings, string_rows, exact, grams = [], [], {}, {}
+    for column in columns:
+        codes, values = pd.factorize(table[column].astype(str))
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+        for i, value in enumerate(values):
+            string_id = len(strings)
+            strings.append(value)
+            string_rows.append(order[bounds[i]:bounds[i + 1]])
+            exact.setdefault(value, []).append(string_id)
+            for gram in {value[j:j + 3] for j in range(len(value) - 2)}:
+                grams.setdefault(gram, []).append(string_id)
+    grams = {gram: np.array(ids) for gram, ids in grams.items()}
+    return {'strings': strings, 'rows': string_rows, 'exact': exact, 'grams': grams}
+
+
+def search_rows(search_index, text, exact=False):
+    # 返回 SKU 或 CAI 等于（exact=True）或包含 text 的升序行号
+    strings = search_index['strings']
+    if exact:
+        ids = search_index['exact'].get(text, [])
+    elif len(text) >= 3:
+        # 先用三元组倒排表求交集得到候选字符串，再逐个确认确实包含 text
+        postings = [search_index['grams'].get(text[j:j + 3]) for j in range(len(text) - 2)]
+        if any(posting is None for posting in postings):
+            ids = []
+        else:
+            postings.sort(key=len)
+            candidates = postings[0]
+            for posting in postings[1:]:
+                candidates = np.intersect1d(candidates, posting, assume_unique=True)
+            ids = [i for i in candidates if text in strings[i]]
+    else:
+        # 不到三个字符没有三元组可用，直接扫一遍不同的字符串（比扫全部行少得多）
+        ids = [i for i, value in enumerate(strings) if text in value]
+    if not ids:
+        return np.empty(0, dtype=np.intp)
+    return np.unique(np.concatenate([search_index['rows'][i] for i in ids]))
+
+
+class LRUCache(BaseCache):
+    # flask_caching 自带的后端超过上限时按写入顺序或隔几个删一个，这里换成真正的 LRU：
+    # 命中的项移到末尾，超过 threshold 时删掉最久没用的
+    def __init__(self, threshold=64, default_timeout=0):
+        super().__init__(default_timeout)
+        self._threshold = threshold
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs['threshold'] = config['CACHE_THRESHOLD']
+        return cls(*args, **kwargs)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._cache:
+                return None
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._threshold:
+                self._cache.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def has(self, key):
+        with self._lock:
+            return key in self._cache
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        return True
+
+
+def process_alive(pid):
+    # 本机上这个进程还在不在；被杀掉、还没被父进程回收的僵尸进程算不在。
+    # 优先用 psutil（dash[diskcache] 的后台任务本来就要装），没有时在 POSIX 上发 0 号信号试探
+    try:
+        import psutil
+    except ImportError:
+        if os.name == 'nt':
+            # Windows 上 os.kill 会直接结束进程，不能拿来试探，只能当它还在，等记录过期
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+class SQLiteCache(BaseCache):
+    # 多个工作进程共用的结果缓存：存在本机的一个 SQLite 文件里（WAL 模式，读不挡写），值用 pickle 序列化，
+    # 超过 threshold 条时删掉最久没用的。flights 表记录正在计算的键，配合 single_flight 让同一个结果只算一次
+    def __init__(self, path, threshold=256, default_timeout=0):
+        super().__init__(default_timeout)
+        self._path = path
+        self._threshold = threshold
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # 建表用临时连接，用完就关：连接不能带进 fork 出来的工作进程
+        db = sqlite3.connect(path, timeout=30)
+        with db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, used REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS flights (key TEXT PRIMARY KEY, pid INTEGER, started REAL)')
+        db.close()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs['path'] = config['CACHE_PATH']
+        kwargs['threshold'] = config['CACHE_THRESHOLD']
+        return cls(*args, **kwargs)
+
+    def _db(self):
+        # 每个线程用自己的连接，fork 之后在子进程里重新连接
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.db = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            self._local.db.execute('PRAGMA synchronous=NORMAL')
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def get(self, key):
+        db = self._db()
+        row = db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        db.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, timeout=None):
+        db = self._db()
+        db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                   (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time()))
+        db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                   (self._threshold,))
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        return self._db().execute('DELETE FROM results WHERE key = ?', (key,)).rowcount > 0
+
+    def has(self, key):
+        return self._db().execute('SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() is not None
+
+    def clear(self):
+        self._db().execute('DELETE FROM results')
+        return True
+
+    def begin_flight(self, key, stale_seconds):
+        # 抢到这个键的计算权返回 True；别的线程或进程正在算时返回 False。
+        # 记录过了 stale_seconds，或者记录里的进程已经不在了（后台任务被新输入取代时会被直接杀掉，来不及删记录），都作废
+        db = self._db()
+        now = time.time()
+        row = db.execute('SELECT pid, started FROM flights WHERE key = ?', (key,)).fetchone()
+        if row is not None and (row[1] < now - stale_seconds or not process_alive(row[0])):
+            # 只删看到的这一条，别的进程刚抢到的新记录不受影响
+            db.execute('DELETE FROM flights WHERE key = ? AND pid = ? AND started = ?', (key, row[0], row[1]))
+        return db.execute('INSERT OR IGNORE INTO flights VALUES (?, ?, ?)', (key, os.getpid(), now)).rowcount == 1
+
+    def end_flight(self, key):
+        self._db().execute('DELETE FROM flights WHERE key = ?', (key,))
+
+
+def data_version(path):
+    # 数据版本：有快照指针时只看指针文件（ETL 最后才替换它），Excel 或预汇总表先写好也不会提前换版本；
+    # 没有指针时看 Excel 的大小和修改时间。文件换了版本跟着变，旧数据的缓存项不会再被命中
+    pointer_file = os.path.splitext(path)[0] + '.current'
+    parts = []
+    for file in [pointer_file if os.path.exists(pointer_file) else path]:
+        if os.path.exists(file):
+            stat = os.stat(file)
+            parts.append('%s:%d:%d' % (os.path.basename(file), stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:12]
+
+
+def data_files(data_dir, prefix):
+    # 各天的数据文件，最新的在前。ETL 先写 Excel、最后才替换快照指针，有指针时以有指针的日期为准：
+    # 今天的 Excel 已经出现、快照还没写好时仍用前一天的，不会先读一遍整个 Excel、等指针出现后再换一次
+    days, pointer_days = set(), set()
+    for filename in os.listdir(data_dir):
+        match = re.fullmatch(re.escape(prefix) + r'(\d{8})(\.xlsx|\.current)', filename)
+        if match:
+            days.add(match.group(1))
+            if match.group(2) == '.current':
+                pointer_days.add(match.group(1))
+    days = sorted(days, key=lambda day: (bool(pointer_days) and day in pointer_days, day), reverse=True)
+    return [os.path.join(data_dir, prefix + day + '.xlsx') for day in days]
+
+
+def find_data_file(data_dir, prefix):
+    # 最新一天的数据文件；今天的 ETL 还没跑完时用前一天的，不会因为找不到今天的文件启动失败
+    files = data_files(data_dir, prefix)
+    return files[0] if files else os.path.join(data_dir, prefix + datetime.now().strftime('%Y%m%d') + '.xlsx')
+
+
+def load_latest(data_dir, prefix, load):
+    # 启动时用 load 加载最新一天的数据；读不了（例如 ETL 正在写）时依次退回前一天的，都不行才报错
+    files = data_files(data_dir, prefix) or [find_data_file(data_dir, prefix)]
+    for file in files[:-1]:
+        try:
+            return load(file)
+        except Exception:
+            logging.exception('加载 %s 失败，改用前一天的数据', os.path.basename(file))
+    return load(files[-1])
+
+
+def query_key(version, start_date, end_date, patterns, sizes, dims, search, everything):
+    # 规范化筛选条件：日期统一格式，选中的值排序去重，含表示全部的 everything（'ALL' 或 'All'）时只记它，
+    # 所以同一个视图只算一次
+    def normalize(selected):
+        if everything in selected:
+            return (everything,)
+        return tuple(sorted(set(selected), key=repr))
+
+    return repr((version, pd.to_datetime(start_date).isoformat(), pd.to_datetime(end_date).isoformat(),
+                 normalize(patterns), normalize(sizes), normalize(dims), str(search or '')))
+
+
+# 监控指标：每次回调各阶段的耗时、进出的行数、缓存命中情况和返回的字节数。多个工作进程和后台任务进程都累加到
+# 同一个 SQLite 文件里，/metrics 按 Prometheus 文本格式输出直方图。MQL_METRICS=0 关闭，MQL_METRICS_LOG=1 时每次回调再记一行 JSON 日志。
+# 回调里不写磁盘：每个进程先在内存里累加，每 MQL_METRICS_FLUSH_SECONDS 秒、/metrics 被抓取时和后台任务算完时一次性写入
+metrics_enabled = os.environ.get('MQL_METRICS', '1') != '0'
+metrics_log = os.environ.get('MQL_METRICS_LOG', '0') == '1'
+metrics_flush_seconds = float(os.environ.get('MQL_METRICS_FLUSH_SECONDS', 15))
+# 指标文件由 add_metrics_routes 按看板设定
+metrics_path = None
+metric_buckets = {
+    'mql_callback_stage_seconds': [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    'mql_callback_rows_in': [10 ** i for i in range(1, 8)],
+    'mql_callback_rows_out': [10 ** i for i in range(1, 8)],
+    'mql_response_bytes': [10 ** i for i in range(2, 8)],
+}
+metric_help = {
+    'mql_callback_stage_seconds': '回调各阶段的耗时（秒）',
+    'mql_callback_rows_in': '筛选前参与的行数',
+    'mql_callback_rows_out': '筛选后选中的行数',
+    'mql_response_bytes': '回调返回给浏览器的字节数',
+    'mql_cache_requests_total': '各级缓存的命中（hit）、未命中（miss）和等别人算完（wait）的次数',
+}
+current_record = contextvars.ContextVar('current_record', default=None)
+metrics_local = threading.local()
+# 本进程还没写入的累加值 {(name, labels, bucket): value}，以及负责定时写入的进程号
+metrics_pending = {}
+metrics_lock = threading.Lock()
+metrics_flusher = None
+
+
+def reset_pending_metrics():
+    # fork 出来的子进程从空表开始（父进程的累加值由父进程自己写入），锁也换一把新的（fork 时可能正被别的线程拿着）
+    global metrics_pending, metrics_lock
+    metrics_pending, metrics_lock = {}, threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_pending_metrics)
+
+
+def metrics_db():
+    # 每个线程用自己的连接，fork 之后在子进程里重新连接
+    if getattr(metrics_local, 'pid', None) != os.getpid():
+        db = sqlite3.connect(metrics_path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        # 指标丢了最后一次写入也无妨，WAL 下不用每个事务都等落盘
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS metrics '
+                   '(name TEXT, labels TEXT, bucket TEXT, value REAL, PRIMARY KEY (name, labels, bucket))')
+        metrics_local.db, metrics_local.pid = db, os.getpid()
+    return metrics_local.db
+
+
+@contextlib.contextmanager
+def stage(name):
+    # 累计当前回调某个阶段的耗时；阶段可以嵌套，外层只记自己的时间（减去内层）
+    record = current_record.get()
+    if record is None:
+        yield
+        return
+    record['stack'].append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        inner = record['stack'].pop()
+        record['stages'][name] = record['stages'].get(name, 0.0) + elapsed - inner
+        if record['stack']:
+            record['stack'][-1] += elapsed
+
+
+def count_cache(name, result):
+    record = current_record.get()
+    if record is not None:
+        record['cache'][name + ':' + result] = record['cache'].get(name + ':' + result, 0) + 1
+
+
+def count_rows(rows_in, rows_out):
+    record = current_record.get()
+    if record is not None:
+        record['rows_in'], record['rows_out'] = int(rows_in), int(rows_out)
+
+
+def observe(updates, name, labels, value):
+    # 直方图：每个桶单独计数，输出时再按 le 累加
+    bucket = next((str(edge) for edge in metric_buckets[name] if value <= edge), '+Inf')
+    updates.extend([(name, labels, bucket, 1), (name, labels, 'sum', value), (name, labels, 'count', 1)])
+
+
+def write_metrics(updates):
+    # 先累加在本进程的内存里；每个进程第一次记录时启动自己的定时写入线程
+    global metrics_flusher
+    with metrics_lock:
+        for name, labels, bucket, value in updates:
+            metrics_pending[name, labels, bucket] = metrics_pending.get((name, labels, bucket), 0) + value
+        if metrics_flusher != os.getpid():
+            metrics_flusher = os.getpid()
+            threading.Thread(target=flush_metrics_periodically, name='metrics-flush', daemon=True).start()
+
+
+def flush_metrics():
+    # 把本进程累加的值在一个事务里写入 SQLite；写入失败（例如别的进程长时间锁着文件）时放回去，下次再写
+    global metrics_pending
+    with metrics_lock:
+        pending, metrics_pending = metrics_pending, {}
+    if not pending or metrics_path is None:
+        return
+    if not os.path.isdir(os.path.dirname(os.path.abspath(metrics_path))):
+        # 数据目录已经删掉了（例如基准测试用完临时目录后退出），没地方写，丢掉这些值
+        return
+    try:
+        with metrics_db() as db:
+            db.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?) '
+                           'ON CONFLICT (name, labels, bucket) DO UPDATE SET value = value + excluded.value',
+                           [key + (value,) for key, value in pending.items()])
+    except sqlite3.Error:
+        logging.exception('写入监控指标失败，下次再试')
+        write_metrics([key + (value,) for key, value in pending.items()])
+
+
+def flush_metrics_periodically():
+    while True:
+        time.sleep(metrics_flush_seconds)
+        flush_metrics()
+
+
+# 单进程运行（app.run_server）正常退出时写入最后一批；app.py 的工作进程用 os._exit 退出，由它自己调用 flush_metrics
+atexit.register(flush_metrics)
+
+
+def record_metrics(record):
+    updates = []
+    labels = 'callback="%s"' % record['callback']
+    for name, seconds in record['stages'].items():
+        observe(updates, 'mql_callback_stage_seconds', labels + ',stage="%s"' % name, seconds)
+    for column in ['rows_in', 'rows_out']:
+        if column in record:
+            observe(updates, 'mql_callback_' + column, labels, record[column])
+    for key, count in record['cache'].items():
+        name, result = key.split(':')
+        updates.append(('mql_cache_requests_total', labels + ',cache="%s",result="%s"' % (name, result), '', count))
+    write_metrics(updates)
+    if metrics_log:
+        logging.info('callback %s', json.dumps({key: value for key, value in record.items() if key != 'stack'},
+                                                ensure_ascii=False))
+
+
+def instrumented(func):
+    # 记录一次回调的各阶段耗时、行数和缓存命中。在请求线程里时先存在 flask.g，等 Dash 序列化完（after_request）
+    # 再记录，顺便记下序列化的耗时和返回的字节数；后台任务进程是在请求里 fork 出来的，看得到请求上下文，
+    # 但没人替它记录，按进程号区分，算完直接记录并写入（任务进程算完就退出，等不到定时写入）
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not metrics_enabled:
+            return func(*args, **kwargs)
+        record = {'callback': func.__name__, 'stages': {}, 'stack': [], 'cache': {}}
+        token = current_record.set(record)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current_record.reset(token)
+            record['seconds'] = time.perf_counter() - start
+            # 没有单独计时的部分（规范化筛选条件、组装返回值等）
+            record['stages']['other'] = max(record['seconds'] - sum(record['stages'].values()), 0.0)
+            if not flask.has_request_context():
+                record_metrics(record)
+            elif flask.g.get('request_pid') == os.getpid():
+                flask.g.callback_record = record
+            else:
+                record_metrics(record)
+                flush_metrics()
+
+    return wrapper
+
+
+def render_metrics():
+    # Prometheus 文本格式：直方图的桶按 le 从小到大累加，最后是 +Inf、_sum、_count。
+    # 抓取时先写入本进程的累加值，其他工作进程的最多晚 MQL_METRICS_FLUSH_SECONDS 秒
+    flush_metrics()
+    series = {}
+    for name, labels, bucket, value in metrics_db().execute('SELECT name, labels, bucket, value FROM metrics'):
+        series.setdefault(name, {}).setdefault(labels, {})[bucket] = value
+    lines = []
+    for name in sorted(series):
+        histogram = name in metric_buckets
+        lines.append('# HELP %s %s' % (name, metric_help[name]))
+        lines.append('# TYPE %s %s' % (name, 'histogram' if histogram else 'counter'))
+        for labels, values in sorted(series[name].items()):
+            if not histogram:
+                lines.append('%s{%s} %g' % (name, labels, values['']))
+                continue
+            total = 0
+            for edge in [str(edge) for edge in metric_buckets[name]] + ['+Inf']:
+                total += values.get(edge, 0)
+                lines.append('%s_bucket{%s,le="%s"} %g' % (name, labels, edge, total))
+            lines.append('%s_sum{%s} %g' % (name, labels, values.get('sum', 0)))
+            lines.append('%s_count{%s} %g' % (name, labels, values.get('count', 0)))
+    return '\n'.join(lines) + '\n'
+
+
+# 等别人算同一个结果最多等多久（秒），也是计算记录作废的时间
+flight_seconds = int(os.environ.get('MQL_FLIGHT_SECONDS', 60))
+
+
+def single_flight(shared_cache, key, build):
+    # 先查共用缓存；没有时抢计算权，抢到的算完写进缓存，没抢到的每 50 毫秒看一次，等到了直接用。
+    # 每次看的时候都重新抢一次：算的进程被杀掉后，begin_flight 发现记录里的进程不在了就作废记录，不用等到超时
+    deadline = time.monotonic() + flight_seconds
+    waited = False
+    while True:
+        with stage('cache'):
+            value = shared_cache.get(key)
+        if value is not None:
+            count_cache('shared', 'wait' if waited else 'hit')
+            return value
+        if shared_cache.cache.begin_flight(key, flight_seconds):
+            try:
+                # 抢到计算权之前别人可能刚算完
+                with stage('cache'):
+                    value = shared_cache.get(key)
+                if value is not None:
+                    count_cache('shared', 'wait')
+                    return value
+                count_cache('shared', 'miss')
+                value = build()
+                with stage('cache'):
+                    shared_cache.set(key, value)
+                return value
+            finally:
+                shared_cache.cache.end_flight(key)
+        if time.monotonic() > deadline:
+            count_cache('shared', 'miss')
+            return build()
+        waited = True
+        time.sleep(0.05)
+
+
+def background_manager(directory):
+    # 后台任务管理器：回调在子进程里算，结果和进度存在本机磁盘上（diskcache），不需要额外的服务。
+    # 子进程是 fork 出来的，直接用已经加载好的数据；没有 fork（Windows 每个任务都要重新导入脚本、读一遍数据）、
+    # 没装 dash[diskcache] 或 MQL_BACKGROUND=0 时返回 None，回调照常在请求线程里算
+    if os.environ.get('MQL_BACKGROUND', '1') == '0' or not hasattr(os, 'fork'):
+        return None
+    try:
+        import diskcache
+        from dash import DiskcacheManager
+        return DiskcacheManager(diskcache.Cache(directory))
+    except ImportError:
+        logging.info('没有安装 dash[diskcache]，回调在请求线程里计算')
+        return None
+
+
+def background_options(manager, *running):
+    # 放到后台进程里算的回调：同一个页面有了新的输入，浏览器会带上还没算完的旧任务，服务器先结束旧任务再开新的，
+    # 不会排一串算到一半就过时的任务；计算期间按 running 改变页面上的提示，页面不会卡住
+    if manager is None:
+        return {}
+    return {'background': True, 'manager': manager, 'running': list(running)}
+
+
+def dimmed(graph_id):
+    # 计算期间图表变淡
+    return Output(graph_id, 'style'), {'opacity': 0.5}, {'opacity': 1}
+
+
+def add_metrics_routes(server, path):
+    # 在看板的 Flask 服务上记录每个回调请求，并提供 /metrics；指标文件默认是 path，MQL_METRICS_PATH 可以改到别处
+    global metrics_path
+    metrics_path = os.environ.get('MQL_METRICS_PATH', path)
+
+    @server.before_request
+    def start_request_timer():
+        flask.g.request_start, flask.g.request_pid = time.perf_counter(), os.getpid()
+
+    @server.after_request
+    def record_request_metrics(response):
+        # 回调请求：记下返回的字节数；回调在这个请求里执行过时，请求总耗时减去回调耗时就是 Dash 校验、序列化等的开销
+        if not metrics_enabled or not flask.request.path.endswith('/_dash-update-component'):
+            return response
+        record = flask.g.pop('callback_record', None)
+        if response.status_code != 200:
+            # 没有返回内容（PreventUpdate 的 204）或出错时只记回调本身
+            if record is not None:
+                record_metrics(record)
+            return response
+        payload = response.get_data()
+        if record is not None:
+            record['stages']['serialize'] = max(time.perf_counter() - flask.g.request_start - record['seconds'], 0.0)
+            record['bytes'] = len(payload)
+            record_metrics(record)
+        if record is not None or b'"response"' in payload:
+            # 后台任务的结果在最后一次轮询时返回，这里也算上
+            updates = []
+            output = (flask.request.get_json(silent=True) or {}).get('output', '')
+            observe(updates, 'mql_response_bytes', 'output="%s"' % output.replace('"', "'"), len(payload))
+            write_metrics(updates)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return flask.Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
@@ -1,61 +1,145 @@
+import os
+import sys
+import logging
 import dash
 from dash import dcc
 from dash import html
+from dash import Patch
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, ALL
 from dash.exceptions import PreventUpdate
 
+# 几个看板共用的代码在 看板公共.py（和 app.py 放在一起）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '米其林-运营软件开发'))
+from 看板公共 import (current_snapshot, load_data, load_cube, compact, sort_by_time, build_time_axis, instrumented, stage,
+                  add_metrics_routes)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+# 数据目录，可以用环境变量 MQL_DATA_DIR 指向别的目录（例如基准测试生成的数据）
+data_dir = os.environ.get('MQL_DATA_DIR', r'C:\GPT')
+
+
+def build_prefix_sums(table, time_axis, measures):
+    # 每个花纹按天累计的各度量之和：sums[m][p, d] 是花纹 p 在前 d 天（从第一天算起）的合计，
+    # 任意日期范围的合计就是两列相减，不用再扫描表；rows 是同样累计的行数，用来判断花纹在范围内有没有数据
+    dates, offsets = time_axis
+    first_day = dates[0].astype('datetime64[D]')
+    day_index = (dates.astype('datetime64[D]') - first_day).astype(np.int64)
+    days = int(day_index[-1]) + 1
+    row_days = np.repeat(day_index, np.diff(offsets))
+
+    patterns = table['花纹'].cat
+    codes = patterns.codes.to_numpy()
+    # 花纹为空的行（code 为 -1）不参与分组，和 groupby 的结果一致
+    valid = codes >= 0
+    keys = codes[valid].astype(np.int64) * days + row_days[valid]
+    size = len(patterns.categories) * days
+
+    def prefix(values):
+        daily = np.bincount(keys, weights=values, minlength=size).reshape(-1, days)
+        return np.concatenate([np.zeros((daily.shape[0], 1)), np.cumsum(daily, axis=1)], axis=1)
+
+    sums = {}
+    for measure in measures:
+        values = table[measure].to_numpy()
+        totals = prefix(values[valid].astype(np.float64))
+        # 整数度量的累计和在 float64 里是精确的，转回整数，显示和原来按范围分组求和一样
+        sums[measure] = totals.astype(np.int64) if values.dtype.kind in 'iub' else totals
+    return {'first_day': pd.Timestamp(first_day), 'days': days, 'patterns': patterns.categories,
+            'rows': prefix(None).astype(np.int64), 'sums': sums}
+
+
+def range_totals(prefix_sums, measure, start_date, end_date):
+    # 日期范围 [start_date, end_date] 内各花纹的合计：每个花纹两次查表，和数据量无关
+    one_day = pd.Timedelta(days=1)
+    days = prefix_sums['days']
+    lo = min(max(int(np.ceil((start_date - prefix_sums['first_day']) / one_day)), 0), days)
+    hi = min(max(int(np.floor((end_date - prefix_sums['first_day']) / one_day)) + 1, lo), days)
+    present = prefix_sums['rows'][:, hi] > prefix_sums['rows'][:, lo]
+    totals = prefix_sums['sums'][measure][:, hi] - prefix_sums['sums'][measure][:, lo]
+    if totals.dtype.kind == 'f':
+        # 浮点累计和相减会带上很小的误差，金额保留两位小数
+        totals = np.round(totals, 2)
+    return prefix_sums['patterns'][present], totals[present]
+
+
 # 读取数据
-df = pd.read_excel(r'C:\GPT\米其林销售表-by day—' + pd.to_datetime('today').strftime('%Y%m%d') + '.xlsx')
+new_file = os.path.join(data_dir, '米其林销售表-by day—' + pd.to_datetime('today').strftime('%Y%m%d') + '.xlsx')
+# 指针只读一次，明细和预汇总表一定是同一个版本
+snapshot_file = current_snapshot(new_file)
+df = load_data(new_file, snapshot_file)
 
 # 确保 '时间' 列都是 datetime 对象
 df['时间'] = pd.to_datetime(df['时间'])
 
+# 对比只按花纹汇总，直接用预汇总表
+cube = sort_by_time(load_cube(snapshot_file, df))
+cube_axis = build_time_axis(cube)
+
+# 维度列转成 category，分组更快、常驻内存更小；整数度量列在 ETL 写快照时已经收窄
+schema = dict.fromkeys(['花纹', '尺寸', 'DIM'], 'category')
+schema.update(dict.fromkeys(['访客数', '成交人数', '成交商品件数', '成交金额', '销售利润'], 'measure'))
+cube = compact(cube, schema, '预汇总表')
+
+# 每个销售度量按花纹、按天的累计和，对比任意多个日期范围都只需要查表
+measures = [column for column, kind in schema.items() if kind == 'measure' and column in cube.columns]
+prefix_sums = build_prefix_sums(cube, cube_axis, measures)
+
+# 快捷对比：本期和往前平移一周、一个月、一年的同期比较
+preset_offsets = {
+    '环比上周': ('上周同期', pd.DateOffset(weeks=1)),
+    '环比上月': ('上月同期', pd.DateOffset(months=1)),
+    '同比去年': ('去年同期', pd.DateOffset(years=1)),
+}
+
 # 创建 Dash 应用
 app = dash.Dash(__name__)
+# 每个回调的耗时和返回字节数，/metrics 输出
+add_metrics_routes(app.server, os.path.join(data_dir, '米其林销售对比-监控指标.sqlite'))
 
 # 获取筛选项的唯一值
 patterns = df['花纹'].unique().tolist()
 sizes = df['尺寸'].unique().tolist()
 dims = df['DIM'].unique().tolist()
 
+def date_range_picker(index):
+    return html.Div([
+        html.Label('时间范围%d' % index),
+        dcc.DatePickerRange(
+            id={'type': 'date-range', 'index': index},
+            min_date_allowed=df['时间'].min(),
+            max_date_allowed=df['时间'].max(),
+            initial_visible_month=df['时间'].min(),
+            start_date=df['时间'].min(),
+            end_date=df['时间'].max()
+        ),
+    ])
+
+
 # 定义布局
 app.layout = html.Div([
     html.Div([
         html.Div([
-            html.Label('开始日期1'),
-            dcc.DatePickerSingle(
-                id='start-date-picker1',
-                min_date_allowed=df['时间'].min(),
-                max_date_allowed=df['时间'].max(),
-                initial_visible_month=df['时间'].min(),
-                date=df['时间'].min()
+            html.Label('对比方式'),
+            dcc.Dropdown(
+                id='preset',
+                options=[{'label': i, 'value': i} for i in ['自定义'] + list(preset_offsets)],
+                value='自定义',
+                clearable=False
             ),
-            html.Label('结束日期1'),
-            dcc.DatePickerSingle(
-                id='end-date-picker1',
-                min_date_allowed=df['时间'].min(),
-                max_date_allowed=df['时间'].max(),
-                initial_visible_month=df['时间'].max(),
-                date=df['时间'].max()
+            html.Label('度量'),
+            dcc.Dropdown(
+                id='measure',
+                options=[{'label': i, 'value': i} for i in measures],
+                value='成交商品件数',
+                clearable=False
             ),
-            html.Label('开始日期2'),
-            dcc.DatePickerSingle(
-                id='start-date-picker2',
-                min_date_allowed=df['时间'].min(),
-                max_date_allowed=df['时间'].max(),
-                initial_visible_month=df['时间'].min(),
-                date=df['时间'].min()
-            ),
-            html.Label('结束日期2'),
-            dcc.DatePickerSingle(
-                id='end-date-picker2',
-                min_date_allowed=df['时间'].min(),
-                max_date_allowed=df['时间'].max(),
-                initial_visible_month=df['时间'].max(),
-                date=df['时间'].max()
-            )
+            # 自定义时对比下面所有的时间范围；快捷对比时用第一个时间范围作本期
+            html.Div(id='date-ranges', children=[date_range_picker(1), date_range_picker(2)]),
+            html.Button('添加时间范围', id='add-range', n_clicks=0),
         ], style={'borderBottom': 'thin lightgrey solid', 'backgroundColor': 'rgb(250, 250, 250)',
                   'padding': '10px 5px'}),
 
@@ -66,44 +150,61 @@ app.layout = html.Div([
     ], style={'width': '100%', 'padding-top': '20px'}),
 ])
 
-def filter_data(start_date, end_date):
-    start_date = pd.to_datetime(start_date)
-    end_date = pd.to_datetime(end_date)
-
-    if start_date > end_date:
-        raise ValueError("结束日期不能早于开始日期")
 
-    mask = (df['时间'] >= start_date) & (df['时间'] <= end_date)
-    filtered_df = df.loc[mask]
-
-    if filtered_df.empty:
-        raise ValueError("没有找到匹配的数据")
+@app.callback(
+    Output('date-ranges', 'children'),
+    Input('add-range', 'n_clicks'),
+    State('date-ranges', 'children'),
+    prevent_initial_call=True
+)
+@instrumented
+def add_range(n_clicks, children):
+    # 只在页面上追加一个日期选择框，不重发已有的
+    patched = Patch()
+    patched.append(date_range_picker(len(children) + 1))
+    return patched
+
+
+def comparison_ranges(start_dates, end_dates, preset):
+    # 要对比的 (名称, 开始, 结束, 是否必须有数据)；快捷对比的同期是推算出来的，没有数据时显示为空
+    ranges = []
+    for k, (start_date, end_date) in enumerate(zip(start_dates, end_dates)):
+        start_date = pd.to_datetime(start_date)
+        end_date = pd.to_datetime(end_date)
+        if start_date > end_date:
+            raise ValueError("结束日期不能早于开始日期")
+        ranges.append(('时间范围%d' % (k + 1), start_date, end_date, True))
+    if preset in preset_offsets and ranges:
+        name, offset = preset_offsets[preset]
+        _, start_date, end_date, _ = ranges[0]
+        ranges = [('本期', start_date, end_date, True), (name, start_date - offset, end_date - offset, False)]
+    return ranges
 
-    return filtered_df
 
 @app.callback(
     Output('graph-output', 'figure'),
-    [Input('start-date-picker1', 'date'),
-     Input('end-date-picker1', 'date'),
-     Input('start-date-picker2', 'date'),
-     Input('end-date-picker2', 'date')]
+    [Input({'type': 'date-range', 'index': ALL}, 'start_date'),
+     Input({'type': 'date-range', 'index': ALL}, 'end_date'),
+     Input('preset', 'value'),
+     Input('measure', 'value')]
 )
-def update_output(start_date1, end_date1, start_date2, end_date2):
+@instrumented
+def update_output(start_dates, end_dates, preset='自定义', measure='成交商品件数'):
+    bars = []
     try:
-        filtered_df1 = filter_data(start_date1, end_date1)
-        filtered_df2 = filter_data(start_date2, end_date2)
-    except ValueError as e:
+        for name, start_date, end_date, required in comparison_ranges(start_dates, end_dates, preset):
+            with stage('groupby'):
+                patterns, totals = range_totals(prefix_sums, measure, start_date, end_date)
+            if required and len(patterns) == 0:
+                raise ValueError("没有找到匹配的数据")
+            with stage('figure'):
+                bars.append(go.Bar(name=name, x=patterns, y=totals, text=totals, textposition='auto'))
+    except (ValueError, TypeError):
         raise PreventUpdate
 
-    grouped_df1 = filtered_df1.groupby('花纹', as_index=False)['成交商品件数'].sum()
-    grouped_df2 = filtered_df2.groupby('花纹', as_index=False)['成交商品件数'].sum()
-
-    fig = go.Figure(data=[
-        go.Bar(name='时间范围1', x=grouped_df1['花纹'], y=grouped_df1['成交商品件数'], text=grouped_df1['成交商品件数'], textposition='auto'),
-        go.Bar(name='时间范围2', x=grouped_df2['花纹'], y=grouped_df2['成交商品件数'], text=grouped_df2['成交商品件数'], textposition='auto')
-    ])
-
-    fig.update_layout(barmode='group')
+    with stage('figure'):
+        fig = go.Figure(data=bars)
+        fig.update_layout(barmode='group')
 
     return fig
 
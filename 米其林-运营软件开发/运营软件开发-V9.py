@@ -1,110 +1,227 @@
+import os
+import sys
+import time
+import logging
+import threading
 import dash
 from dash import dcc
 from dash import html
+from dash import Patch
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
+import flask_caching
+
+# 几个看板共用的代码在 看板公共.py（和 app.py 放在一起）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '米其林-运营软件开发'))
+from 看板公共 import (current_snapshot, load_data, load_cube, compact, sort_by_time, build_time_axis, date_range_rows,
+                  build_groups, grouped, build_index, lookup_rows, build_search_index, search_rows, data_version,
+                  find_data_file, load_latest, query_key, single_flight, background_manager, background_options,
+                  dimmed, instrumented, stage, count_rows, count_cache, add_metrics_routes)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+# 数据目录，可以用环境变量 MQL_DATA_DIR 指向别的目录（例如基准测试生成的数据）
+data_dir = os.environ.get('MQL_DATA_DIR', r'C:\GPT')
+
+
+# 维度列转成 category，分组更快、常驻内存更小；整数度量列在 ETL 写快照时已经收窄
+dimension_columns = ['花纹', '尺寸', 'DIM']
+schema = dict.fromkeys(['花纹', '尺寸', 'DIM', 'SKU', 'CAI'], 'category')
+# "成本" 只用来算销售利润，不参与分组，保持快照里的 float64 直接映射，不再转换
+schema.update(dict.fromkeys(['访客数', '成交人数', '成交商品件数', '成交金额', '销售利润'], 'measure'))
+
+data_prefix = '米其林销售表-by day—'
+# 多久检查一次有没有新的数据文件（秒），0 表示不检查
+reload_seconds = int(os.environ.get('MQL_RELOAD_SECONDS', 60))
+
+
+def load_dataset(new_file):
+    # 读取一个版本的数据并建好所有索引；回调只通过 dataset 这一个引用取数据，换版本时整体替换
+    version = data_version(new_file)
+    # 指针只读一次，明细和预汇总表一定是同一个版本
+    snapshot_file = current_snapshot(new_file)
+    df = load_data(new_file, snapshot_file)
+
+    # 确保 '时间' 列都是 datetime 对象
+    df['时间'] = pd.to_datetime(df['时间'])
+
+    # 按时间排序，日期范围用二分查找直接切片
+    df = sort_by_time(df)
+
+    # 获取筛选项的唯一值
+    patterns = df['花纹'].unique().tolist()
+    sizes = df['尺寸'].unique().tolist()
+    dims = df['DIM'].unique().tolist()
+
+    # 在每个 SKU 的级别上计算销售利润
+    df['销售利润'] = df['成交金额'] - df['成本'] * df['成交商品件数']
+
+    # 预汇总表里已经有按 (时间, 花纹, 尺寸, DIM) 汇总的销售利润
+    cube = sort_by_time(load_cube(snapshot_file, df))
+    df_axis = build_time_axis(df)
+    cube_axis = df_axis if cube is df else build_time_axis(cube)
+
+    df = compact(df, schema, '明细')
+    if cube is not df:
+        cube = compact(cube, schema, '预汇总表')
+
+    # 按花纹、按日期分组用的整数编码
+    df_groups = build_groups(df, df_axis)
+    cube_groups = df_groups if cube is df else build_groups(cube, cube_axis)
+
+    # 花纹/尺寸/DIM 的倒排索引，筛选时先求行号再只 take 一次，不再对整张表 isin 三遍
+    df_index = build_index(df, dimension_columns)
+    cube_index = df_index if cube is df else build_index(cube, dimension_columns)
+
+    return {
+        'path': new_file,
+        'version': version,
+        'df': df,
+        'cube': cube,
+        'df_axis': df_axis,
+        'cube_axis': cube_axis,
+        'df_groups': df_groups,
+        'cube_groups': cube_groups,
+        'df_index': df_index,
+        'cube_index': cube_index,
+        # SKU/CAI 搜索索引，搜索时不再对每一行做字符串比较
+        'search_index': build_search_index(df, ['SKU', 'CAI']),
+        'patterns': patterns,
+        'sizes': sizes,
+        'dims': dims,
+    }
 
-# 读取数据
-df = pd.read_excel(r'C:\GPT\米其林销售表-by day—' + pd.to_datetime('today').strftime('%Y%m%d') + '.xlsx')
 
-# 确保 '时间' 列都是 datetime 对象
-df['时间'] = pd.to_datetime(df['时间'])
+# 读取数据
+# 最新一天的数据读不了时退回前一天的
+dataset = load_latest(data_dir, data_prefix, load_dataset)
 
 # 创建 Dash 应用
 app = dash.Dash(__name__)
 
-# 获取筛选项的唯一值
-patterns = df['花纹'].unique().tolist()
-sizes = df['尺寸'].unique().tolist()
-dims = df['DIM'].unique().tolist()
-
-# 在每个 SKU 的级别上计算销售利润
-df['销售利润'] = df['成交金额'] - df['成本'] * df['成交商品件数']
-
-# 定义布局
-app.layout = html.Div([
-    html.Div([
+# 筛选结果和图表数据缓存：键是规范化的筛选条件加数据版本，最多保留 MQL_CACHE_ENTRIES 组结果，超出时淘汰最久没用的
+cache = flask_caching.Cache(app.server, config={
+    'CACHE_TYPE': '看板公共.LRUCache',
+    'CACHE_THRESHOLD': int(os.environ.get('MQL_CACHE_ENTRIES', 64)),
+})
+# 各个工作进程共用的图表结果缓存：键同样是数据版本加规范化的筛选条件，最多保留 MQL_SHARED_CACHE_ENTRIES 组结果。
+# 早上 ETL 跑完后很多人同时打开默认视图，只有一个进程在算，其余的等它写进来直接读
+shared_cache = flask_caching.Cache(app.server, config={
+    'CACHE_TYPE': '看板公共.SQLiteCache',
+    'CACHE_PATH': os.environ.get('MQL_SHARED_CACHE', os.path.join(data_dir, '米其林销售-结果缓存.sqlite')),
+    'CACHE_THRESHOLD': int(os.environ.get('MQL_SHARED_CACHE_ENTRIES', 256)),
+})
+# 回调在后台进程里算（不能用时返回 None，照常在请求线程里算）
+manager = background_manager(os.path.join(data_dir, '米其林销售-后台任务'))
+# 每个回调的耗时、行数、缓存命中和返回字节数，/metrics 输出
+add_metrics_routes(app.server, os.path.join(data_dir, '米其林销售-监控指标.sqlite'))
+
+
+def dropdown_options(values):
+    return [{'label': 'All', 'value': 'All'}] + [{'label': i, 'value': i} for i in values]
+
+
+# 定义布局：每次打开页面时按当前数据生成，日期范围和下拉选项跟着数据版本走
+def serve_layout():
+    data = dataset
+    df = data['df']
+    return html.Div([
         html.Div([
             html.Div([
-                html.Label('开始日期'),
-                dcc.DatePickerSingle(
-                    id='start-date-picker',
-                    min_date_allowed=df['时间'].min(),
-                    max_date_allowed=df['时间'].max(),
-                    initial_visible_month=df['时间'].min(),
-                    date=df['时间'].min()
-                ),
-            ], style={'width': '48%', 'display': 'inline-block'}),
+                html.Div([
+                    html.Label('开始日期'),
+                    dcc.DatePickerSingle(
+                        id='start-date-picker',
+                        min_date_allowed=df['时间'].min(),
+                        max_date_allowed=df['时间'].max(),
+                        initial_visible_month=df['时间'].min(),
+                        date=df['时间'].min()
+                    ),
+                ], style={'width': '48%', 'display': 'inline-block'}),
+                html.Div([
+                    html.Label('结束日期'),
+                    dcc.DatePickerSingle(
+                        id='end-date-picker',
+                        min_date_allowed=df['时间'].min(),
+                        max_date_allowed=df['时间'].max(),
+                        initial_visible_month=df['时间'].max(),
+                        date=df['时间'].max()
+                    ),
+                ], style={'width': '48%', 'float': 'right', 'display': 'inline-block'})
+            ], style={'borderBottom': 'thin lightgrey solid', 'backgroundColor': 'rgb(250, 250, 250)',
+                      'padding': '10px 5px'}),
             html.Div([
-                html.Label('结束日期'),
-                dcc.DatePickerSingle(
-                    id='end-date-picker',
-                    min_date_allowed=df['时间'].min(),
-                    max_date_allowed=df['时间'].max(),
-                    initial_visible_month=df['时间'].max(),
-                    date=df['时间'].max()
-                ),
-            ], style={'width': '48%', 'float': 'right', 'display': 'inline-block'})
-        ], style={'borderBottom': 'thin lightgrey solid', 'backgroundColor': 'rgb(250, 250, 250)',
-                  'padding': '10px 5px'}),
-        html.Div([
+                html.Div([
+                    html.Label('花纹'),
+                    dcc.Dropdown(
+                        id='pattern-filter',
+                        options=dropdown_options(data['patterns']),
+                        value='All',
+                        multi=True
+                    ),
+                ], style={'width': '30%', 'display': 'inline-block'}),
+                html.Div([
+                    html.Label('尺寸'),
+                    dcc.Dropdown(
+                        id='size-filter',
+                        options=dropdown_options(data['sizes']),
+                        value='All',
+                        multi=True
+                    ),
+                ], style={'width': '30%', 'display': 'inline-block'}),
+                html.Div([
+                    html.Label('DIM'),
+                    dcc.Dropdown(
+                        id='dim-filter',
+                        options=dropdown_options(data['dims']),
+                        value='All',
+                        multi=True
+                    ),
+                ], style={'width': '30%', 'float': 'right', 'display': 'inline-block'})
+            ], style={'padding': '10px 5px'}),
             html.Div([
-                html.Label('花纹'),
-                dcc.Dropdown(
-                    id='pattern-filter',
-                    options=[{'label': 'All', 'value': 'All'}] + [{'label': i, 'value': i} for i in patterns],
-                    value='All',
-                    multi=True
+                html.Label('SKU / CAI 搜索'),
+                dcc.Input(
+                    id='search-box',
+                    type='text',
+                    placeholder='输入 SKU 或 CAI',
+                    # 停止输入半秒后再发给服务器，连续输入不会每个字符都触发一次计算
+                    debounce=0.5
                 ),
-            ], style={'width': '30%', 'display': 'inline-block'}),
-            html.Div([
-                html.Label('尺寸'),
-                dcc.Dropdown(
-                    id='size-filter',
-                    options=[{'label': 'All', 'value': 'All'}] + [{'label': i, 'value': i} for i in sizes],
-                    value='All',
-                    multi=True
-                ),
-            ], style={'width': '30%', 'display': 'inline-block'}),
-            html.Div([
-                html.Label('DIM'),
-                dcc.Dropdown(
-                    id='dim-filter',
-                    options=[{'label': 'All', 'value': 'All'}] + [{'label': i, 'value': i} for i in dims],
-                    value='All',
-                    multi=True
-                ),
-            ], style={'width': '30%', 'float': 'right', 'display': 'inline-block'})
-        ], style={'padding': '10px 5px'}),
+            ], style={'padding': '10px 5px'}),
+            # 定时检查服务器上的数据版本，换了版本就刷新选项和图表
+            dcc.Interval(id='reload-interval', interval=max(reload_seconds, 1) * 1000, disabled=reload_seconds <= 0),
+            dcc.Store(id='data-version', data=data['version']),
+        ], style={'width': '48%', 'display': 'inline-block', 'vertical-align': 'top'}),
+        html.Div([
+            html.H3('各花纹的销售数量'),
+            dcc.Graph(id='graph-output')
+        ], style={'width': '100%', 'padding-top': '20px'}),
+        html.Div([
+            html.H3('访客数和转化率'),
+            dcc.Graph(id='combo-graph-output', figure=go.Figure(layout=dict(
+                yaxis=dict(title='访客数', titlefont=dict(color="#1f77b4"), tickfont=dict(color="#1f77b4")),
+                yaxis2=dict(title='转化率', titlefont=dict(color="#ff7f0e"), tickfont=dict(color="#ff7f0e"),
+                            anchor="free", overlaying="y", side="right", position=1))))
+        ], style={'width': '100%', 'padding-top': '20px'}),
         html.Div([
-            html.Label('SKU / CAI 搜索'),
-            dcc.Input(
-                id='search-box',
-                type='text',
-                placeholder='输入 SKU 或 CAI'
-            ),
-        ], style={'padding': '10px 5px'}),
-    ], style={'width': '48%', 'display': 'inline-block', 'vertical-align': 'top'}),
-    html.Div([
-        html.H3('各花纹的销售数量'),
-        dcc.Graph(id='graph-output')
-    ], style={'width': '100%', 'padding-top': '20px'}),
-    html.Div([
-        html.H3('访客数和转化率'),
-        dcc.Graph(id='combo-graph-output')
-    ], style={'width': '100%', 'padding-top': '20px'}),
-    html.Div([
-        html.H3('成交商品件数和件单价'),
-        dcc.Graph(id='second-combo-graph-output')
-    ], style={'width': '100%', 'padding-top': '20px'}),
-    html.Div([
-        html.H3('各花纹的销售利润'),
-        dcc.Graph(id='profit-graph-output')
-    ], style={'width': '100%', 'padding-top': '20px'}),
-])
+            html.H3('成交商品件数和件单价'),
+            dcc.Graph(id='second-combo-graph-output', figure=go.Figure(layout=dict(
+                yaxis=dict(title='成交商品件数', titlefont=dict(color="#1f77b4"), tickfont=dict(color="#1f77b4")),
+                yaxis2=dict(title='件单价', titlefont=dict(color="#ff7f0e"), tickfont=dict(color="#ff7f0e"),
+                            anchor="free", overlaying="y", side="right", position=1))))
+        ], style={'width': '100%', 'padding-top': '20px'}),
+        html.Div([
+            html.H3('各花纹的销售利润'),
+            dcc.Graph(id='profit-graph-output')
+        ], style={'width': '100%', 'padding-top': '20px'}),
+    ])
+
 
+app.layout = serve_layout
 
 
 def get_total(grouped_df):
@@ -113,37 +230,64 @@ def get_total(grouped_df):
     return pd.concat([grouped_df, total_df], ignore_index=True)
 
 
-def update_output(start_date, end_date, selected_patterns, selected_sizes, selected_dims, search_value):
+def update_output(start_date, end_date, selected_patterns, selected_sizes, selected_dims, search_value, data=None):
+    # 各个图表共用的筛选结果：用明细还是预汇总表、选中的行（连续切片或升序行号），按规范化的筛选条件缓存
+    data = dataset if data is None else data
     start_date = pd.to_datetime(start_date)
     end_date = pd.to_datetime(end_date)
 
     if start_date > end_date:
         raise ValueError("结束日期不能早于开始日期")
 
-    mask = (df['时间'] >= start_date) & (df['时间'] <= end_date)
-    filtered_df = df.loc[mask]
-
-    if 'All' not in selected_patterns:
-        filtered_df = filtered_df[filtered_df['花纹'].isin(selected_patterns)]
-    if 'All' not in selected_sizes:
-        filtered_df = filtered_df[filtered_df['尺寸'].isin(selected_sizes)]
-    if 'All' not in selected_dims:
-        filtered_df = filtered_df[filtered_df['DIM'].isin(selected_dims)]
-    if not selected_patterns:
-        selected_patterns = ['All']
-    if not selected_sizes:
-        selected_sizes = ['All']
-    if not selected_dims:
-        selected_dims = ['All']
-
-    if search_value:
-        filtered_df = filtered_df[
-            (filtered_df['SKU'].astype(str) == search_value) | (filtered_df['CAI'].astype(str) == search_value)]
-
-    if filtered_df.empty:
+    key = query_key(data['version'], start_date, end_date, selected_patterns, selected_sizes, selected_dims, search_value,
+                    'All')
+    selection = cache.get('rows|' + key)
+    if selection is not None:
+        count_cache('rows', 'hit')
+        return selection
+    count_cache('rows', 'miss')
+
+    with stage('filter'):
+        # 没有 SKU/CAI 搜索时用预汇总表，要筛选和分组的行数少得多
+        table = 'df' if search_value else 'cube'
+        source, index, time_axis = data[table], data[table + '_index'], data[table + '_axis']
+        lo, hi = date_range_rows(time_axis, start_date, end_date)
+        filters = {column: selected for column, selected in
+                   zip(dimension_columns, [selected_patterns, selected_sizes, selected_dims]) if 'All' not in selected}
+        rows = lookup_rows(index, filters)
+        if search_value:
+            matched = search_rows(data['search_index'], search_value, exact=True)
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        if rows is None:
+            rows = slice(lo, hi)
+        else:
+            rows = rows[np.searchsorted(rows, lo):np.searchsorted(rows, hi)]
+        count_rows(len(source), len(source.index[rows]))
+
+    if len(source.index[rows]) == 0:
         raise ValueError("没有找到匹配的数据")
 
-    return filtered_df
+    selection = {'source': source, 'rows': rows, 'key': key, 'groups': data[table + '_groups']}
+    cache.set('rows|' + key, selection)
+    return selection
+
+
+def figure_traces(build_traces, selection):
+    with stage('figure'):
+        return build_traces(selection)
+
+
+def patch_traces(name, build_traces, data, *filters):
+    # 图表的布局在页面里只发一次，筛选变化时只替换 data；每个图表的 traces 放在各进程共用的缓存里，
+    # 同一个结果同时只有一个进程在算
+    try:
+        key = name + '|' + query_key(data['version'], *filters, 'All')
+        traces = single_flight(shared_cache, key, lambda: figure_traces(build_traces, update_output(*filters, data=data)))
+    except ValueError:
+        return dash.no_update
+    patched = Patch()
+    patched['data'] = traces
+    return patched
 
 
 def create_bar_figure(x, y):
@@ -173,113 +317,122 @@ def create_combo_figure(x, y1, y2, y1_name, y2_name):
         )
     )
 
-@app.callback(
-    Output('graph-output', 'figure'),
-    Output('combo-graph-output', 'figure'),
-    Output('second-combo-graph-output', 'figure'),
-    Output('profit-graph-output', 'figure'),
-    [Input('start-date-picker', 'date'),
-     Input('end-date-picker', 'date'),
-     Input('pattern-filter', 'value'),
-     Input('size-filter', 'value'),
-     Input('dim-filter', 'value'),
-     Input('search-box', 'value')]
-)
-def update_figures(start_date, end_date, selected_patterns, selected_sizes, selected_dims, search_value):
-    try:
-        filtered_df = update_output(start_date, end_date, selected_patterns, selected_sizes, selected_dims, search_value)
-    except ValueError as e:
-        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+# 按花纹的度量一次算完，件数图和利润图共用；按日期的度量也一次算完，两个组合图共用
+pattern_measures = ['成交商品件数', '销售利润']
+date_measures = ['访客数', '成交人数', '成交商品件数', '成交金额']
 
-    grouped_df = filtered_df.groupby('花纹', as_index=False)['成交商品件数'].sum()
+
+def pattern_traces(selection):
+    grouped_df = grouped(cache, selection, '花纹', pattern_measures)[['成交商品件数']].reset_index()
     total_grouped_df = get_total(grouped_df)
+    return [go.Bar(x=total_grouped_df['花纹'], y=total_grouped_df['成交商品件数'], text=total_grouped_df['成交商品件数'],
+                   textposition='auto')]
 
-    fig = go.Figure(data=[
-        go.Bar(x=total_grouped_df['花纹'], y=total_grouped_df['成交商品件数'], text=total_grouped_df['成交商品件数'], textposition='auto')
-    ])
 
-    grouped_df_by_date = filtered_df.groupby('时间', as_index=False).agg({'访客数': 'sum', '成交人数': 'sum'})
+def visitor_traces(selection):
+    grouped_df_by_date = grouped(cache, selection, '时间', date_measures)[['访客数', '成交人数']].reset_index()
     grouped_df_by_date['转化率'] = grouped_df_by_date['成交人数'] / grouped_df_by_date['访客数']
-
-    fig_combo = go.Figure(data=[
+    return [
         go.Bar(name='访客数', x=grouped_df_by_date["时间"], y=grouped_df_by_date["访客数"],
                text=grouped_df_by_date["访客数"], textposition='auto'),
         go.Scatter(name='转化率', x=grouped_df_by_date["时间"], y=grouped_df_by_date["转化率"], yaxis='y2',
                    mode='lines+markers', text=grouped_df_by_date["转化率"].apply(lambda x: '{:.2%}'.format(x)),
                    textposition="top center"),
-    ])
+    ]
 
-    fig_combo.update_layout(
-        yaxis=dict(
-            title='访客数',
-            titlefont=dict(
-                color="#1f77b4"
-            ),
-            tickfont=dict(
-                color="#1f77b4"
-            )
-        ),
-        yaxis2=dict(
-            title='转化率',
-            titlefont=dict(
-                color="#ff7f0e"
-            ),
-            tickfont=dict(
-                color="#ff7f0e"
-            ),
-            anchor="free",
-            overlaying="y",
-            side="right",
-            position=1
-        )
-    )
 
-    grouped_df_by_date_2 = filtered_df.groupby('时间', as_index=False).agg({'成交商品件数': 'sum', '成交金额': 'sum'})
+def pieces_traces(selection):
+    grouped_df_by_date_2 = grouped(cache, selection, '时间', date_measures)[['成交商品件数', '成交金额']].reset_index()
     grouped_df_by_date_2['件单价'] = grouped_df_by_date_2['成交金额'] / grouped_df_by_date_2['成交商品件数']
-
-    fig_combo_2 = go.Figure(data=[
+    return [
         go.Bar(name='成交商品件数', x=grouped_df_by_date_2["时间"], y=grouped_df_by_date_2["成交商品件数"],
                text=grouped_df_by_date_2["成交商品件数"], textposition='auto'),
         go.Scatter(name='件单价', x=grouped_df_by_date_2["时间"], y=grouped_df_by_date_2["件单价"], yaxis='y2',
                    mode='lines+markers', text=grouped_df_by_date_2["件单价"].apply(lambda x: '{:.0f}'.format(x)),
                    textposition="top center"),
-    ])
+    ]
 
-    fig_combo_2.update_layout(
-        yaxis=dict(
-            title='成交商品件数',
-            titlefont=dict(
-                color="#1f77b4"
-            ),
-            tickfont=dict(
-                color="#1f77b4"
-            )
-        ),
-        yaxis2=dict(
-            title='件单价',
-            titlefont=dict(
-                color="#ff7f0e"
-            ),
-            tickfont=dict(
-                color="#ff7f0e"
-            ),
-            anchor="free",
-            overlaying="y",
-            side="right",
-            position=1
-        )
-    )
 
+def profit_traces(selection):
     # 计算每个花纹的销售利润
-    grouped_df_profit = filtered_df.groupby('花纹', as_index=False)['销售利润'].sum()
-    fig_profit = go.Figure(data=[
-        go.Bar(name='销售利润', x=grouped_df_profit['花纹'], y=grouped_df_profit['销售利润'],
-               text=grouped_df_profit['销售利润'], textposition='auto')
-    ])
-
-    # 返回图像
-    return fig, fig_combo, fig_combo_2, fig_profit
-
+    grouped_df_profit = grouped(cache, selection, '花纹', pattern_measures)[['销售利润']].reset_index()
+    return [go.Bar(name='销售利润', x=grouped_df_profit['花纹'], y=grouped_df_profit['销售利润'],
+                   text=grouped_df_profit['销售利润'], textposition='auto')]
+
+
+filter_inputs = [Input('start-date-picker', 'date'),
+                 Input('end-date-picker', 'date'),
+                 Input('pattern-filter', 'value'),
+                 Input('size-filter', 'value'),
+                 Input('dim-filter', 'value'),
+                 Input('search-box', 'value'),
+                 Input('data-version', 'data')]
+
+
+# 四个图表在一个回调里算完：放到后台时每次操作只 fork 一个任务进程，筛选结果和按花纹、按日期的分组在这个进程里各算一次
+@app.callback(Output('graph-output', 'figure'),
+              Output('combo-graph-output', 'figure'),
+              Output('second-combo-graph-output', 'figure'),
+              Output('profit-graph-output', 'figure'),
+              filter_inputs,
+              **background_options(manager, dimmed('graph-output'), dimmed('combo-graph-output'),
+                                   dimmed('second-combo-graph-output'), dimmed('profit-graph-output')))
+@instrumented
+def update_figures(start_date, end_date, selected_patterns, selected_sizes, selected_dims, search_value, version=None):
+    # 开始时取一次 dataset 引用，中途换了新版本这次回调也用旧版本算完
+    data = dataset
+    filters = (start_date, end_date, selected_patterns, selected_sizes, selected_dims, search_value)
+    return (patch_traces('pattern', pattern_traces, data, *filters), patch_traces('visitor', visitor_traces, data, *filters),
+            patch_traces('pieces', pieces_traces, data, *filters), patch_traces('profit', profit_traces, data, *filters))
+
+
+@app.callback(Output('data-version', 'data'),
+              Output('pattern-filter', 'options'),
+              Output('size-filter', 'options'),
+              Output('dim-filter', 'options'),
+              Output('start-date-picker', 'min_date_allowed'),
+              Output('start-date-picker', 'max_date_allowed'),
+              Output('end-date-picker', 'min_date_allowed'),
+              Output('end-date-picker', 'max_date_allowed'),
+              Input('reload-interval', 'n_intervals'),
+              State('data-version', 'data'),
+              prevent_initial_call=True)
+@instrumented
+def refresh_options(n_intervals, version):
+    # 服务器换了数据版本时更新已打开页面的下拉选项和日期范围；data-version 变了也会触发各图表重算
+    data = dataset
+    if data['version'] == version:
+        raise PreventUpdate
+    first, last = data['df']['时间'].min(), data['df']['时间'].max()
+    return (data['version'], dropdown_options(data['patterns']), dropdown_options(data['sizes']),
+            dropdown_options(data['dims']), first, last, first, last)
+
+
+def reload_dataset():
+    # 发现更新的数据文件（换了日期，或者 ETL 重写了当天的文件）时，在后台读好、建好索引，再一次性替换 dataset；
+    # 正在执行的回调拿的是旧引用，照常算完；缓存键里有数据版本，旧版本的缓存项不会再被命中，这里直接清掉
+    global dataset
+    new_file = find_data_file(data_dir, data_prefix)
+    if new_file == dataset['path'] and data_version(new_file) == dataset['version']:
+        return False
+    dataset = load_dataset(new_file)
+    cache.clear()
+    logging.info('已切换到新数据 %s（版本 %s）', os.path.basename(new_file), dataset['version'])
+    return True
+
+
+def watch_data_files():
+    while True:
+        time.sleep(reload_seconds)
+        try:
+            reload_dataset()
+        except Exception:
+            # ETL 还在写文件时可能读到不完整的数据，继续用当前版本，下次再试
+            logging.exception('重新加载数据失败，继续使用当前版本')
+
+
+if reload_seconds > 0:
+    threading.Thread(target=watch_data_files, name='data-watcher', daemon=True).start()
 
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file